@@ -1,9 +1,13 @@
+import time
+
 import streamlit as st
 from streamlit_tags import st_tags
 
 from main import vacation_requests
 from vacation_date_to_week_index import vacation_date_to_week_index
-from main import optimize_schedule
+from main import read_schedule, BLOCKED_RULES
+from schedule_cache import ScheduleCache
+from jobs import JobPool
 
 st.markdown("# People")
 
@@ -18,24 +22,24 @@ W = 52
 
 with st.expander("# Rules"):
 
-    ncc_fellows_assigned_fully = st.checkbox("Assign entire 52-week schedule for jr and sr NCC fellows")
+    ncc_fellows_assigned_fully = st.checkbox("Assign entire 52-week schedule for jr and sr NCC fellows", value=True)
     # st.checkbox("Fellows can have only one rotation per week")
     col1, col2 = st.columns(2)
     with col1:
-        ncc_shifts_covered = st.checkbox("All NCC shifts must be covered")
+        ncc_shifts_covered = st.checkbox("All NCC shifts must be covered", value=True)
     with col2:
         if ncc_shifts_covered:
-            swing_deficit = st.number_input("Except for this many swing shifts covered by ad hoc rotation", value=0, step=1)
+            swing_deficit = st.number_input("Except for this many swing shifts covered by ad hoc rotation", min_value=0, value=8, step=1)
 
     max_consecutive_icu = st.number_input("Fellows may have this many core ICU shifts in a row", min_value=2, max_value=20, value=8, step=1)
-    jr_start_micu = st.checkbox("Junior fellows start with MICU their first month")
-    jr_ncc_before_week = st.number_input("Junior fellows should hit NCC before this week", min_value=0, max_value=52, value=19, step=1)
+    jr_start_micu = st.checkbox("Junior fellows start with MICU their first month", value=True)
+    jr_ncc_before_week = st.number_input("Junior fellows should hit NCC before this week", min_value=5, max_value=52, value=19, step=1)
     jr_ncc_before_swing = st.number_input("Junior fellows should have this many NCC shifts before swing", min_value=0, max_value=12, value=4, step=1)
 
     # custom requests like "the fourth block needs two micu fellows
-    blocked_up = st.checkbox("Shifts are 'blocked': into four or two week chunks.")
+    blocked_up = st.checkbox("Shifts are 'blocked': into four or two week chunks.", value=True)
 
-    ncc_oversight = st.checkbox("At least one NCC team should have an NCC or Stroke fellow at all times.")
+    ncc_oversight = st.checkbox("At least one NCC team should have an NCC or Stroke fellow at all times.", value=True)
 
 with st.expander("## Vacation"):
 
@@ -87,41 +91,155 @@ def bg_color(x):
 # st.dataframe(df1.style.applymap(lambda x: bg_color(x)), #[{'selector': 'MICU', 'props': 'background-color: #e6ffe6;'}]),
 #              hide_index=True)
 
-# don't bother using options yet.
+# Rules switched by the checkboxes above. The compiled model is shared across
+# reruns, so changing these only re-checks it under different assumptions.
+rules = {
+    "range_fellows_assigned_fully": ncc_fellows_assigned_fully,
+    "ncc_shifts_covered_swing_deficit": {"deficit": swing_deficit} if ncc_shifts_covered else False,
+    "maximum_consecutive_icu_shifts": {"MAX_CONSEC": max_consecutive_icu},
+    "jr_first_month_micu": jr_start_micu,
+    "jr_ncc_before_19": {"last_week": jr_ncc_before_week},
+    "jr_fellows_n_ncc_before_swing": {"n": jr_ncc_before_swing},
+    "ncc_stroke_oversight": ncc_oversight,
+    **{name: blocked_up for name in BLOCKED_RULES},
+}
+
+# cp-sat needs ortools installed
+backend = st.selectbox("Solver", ["z3", "cp-sat"])
+time_limit = st.number_input("Time limit (seconds)", min_value=1, value=60, step=10)
+
+alternatives = st.number_input("Alternative schedules", min_value=1, max_value=10, value=1, step=1)
+
+# for "why is this slow?": see show_profile
+instrumentation = st.checkbox("Show what each rule adds to the model, and the solver's statistics")
+
+with st.expander("## Repair an existing schedule"):
+    # e.g. after a vacation changes mid-year: keep the weeks already worked, and
+    # change as little as possible after them
+    previous_workbook = st.file_uploader("Previous schedule (a workbook written by the scheduler)", type="xlsx")
+    from_week = st.number_input("Keep every week before this one", min_value=0, max_value=W, value=0, step=1)
+
+def show_schedule(shifts_for_fellows, fellows_for_shifts):
+    import pandas
+    df1 = pandas.DataFrame.from_dict([
+        {
+            'Week': ii,
+            **{jr: shifts_for_fellows[jr][ii] for jr in jr_fellows},
+            **{sr: shifts_for_fellows[sr][ii] for sr in sr_fellows}
+
+        }
+    for ii in range(W)])
+
+    st.dataframe(df1.style.applymap(lambda x: bg_color(x)), #[{'selector': 'MICU', 'props': 'background-color: #e6ffe6;'}]),
+         hide_index=True)
+
+    df2 = pandas.DataFrame.from_dict([
+        {
+            'Week': ii,
+            **{s: fellows_for_shifts[s][ii] for s in ['NCC1', 'NCC2', 'Extra', 'Swing']},
+        }
+    for ii in range(W)])
+
+    st.dataframe(df2.style.applymap(lambda x: bg_color(x)), #[{'selector': 'MICU', 'props': 'background-color: #e6ffe6;'}]),
+         hide_index=True)
+
+def show_failure(report):
+    if report["status"] == "unknown":
+        st.error(f"No schedule found within the {time_limit}s time limit.")
+    else:
+        st.error(f"No schedule ({report['status']}). Conflicting rules: " + " vs ".join(report.get("conflicts", [])))
+
+def show_profile(report):
+    import pandas
+    if "profile" not in report:
+        return
+    with st.expander("## Model and solver statistics"):
+        # one row per rule, the most expensive to build first
+        df = pandas.DataFrame.from_dict(report["profile"], orient="index")
+        df.index.name = "rule"
+        st.dataframe(df.sort_values("time", ascending=False))
+        st.caption(f"{report['presolve']['fixed']} of {report['presolve']['cells']} cells decided before solving.")
+        st.dataframe(pandas.DataFrame(report["statistics"].items(), columns=["statistic", "value"]), hide_index=True)
+
+@st.cache_resource
+def job_pool():
+    # One pool of solver processes for the server, shared by every session: a
+    # solve runs in the background while the page polls it, and an identical
+    # request joins the job already under way (see jobs.py).
+    return JobPool(cache=ScheduleCache())
+
 if st.button("optimize"):
-    with st.spinner():
-        shifts_for_fellows, fellows_for_shifts = optimize_schedule(
-            jr_fellows,
-            sr_fellows,
-            stroke_fellows,
-            CCM_fellows,
-            R,
-            fellow_week_pairs=vacation_requests
-        )
-
-        import pandas
-        df1 = pandas.DataFrame.from_dict([
-            {
-                'Week': ii,
-                **{jr: shifts_for_fellows[jr][ii] for jr in jr_fellows},
-                **{sr: shifts_for_fellows[sr][ii] for sr in sr_fellows}
-
-            }
-        for ii in range(W)])
-
-        st.dataframe(df1.style.applymap(lambda x: bg_color(x)), #[{'selector': 'MICU', 'props': 'background-color: #e6ffe6;'}]),
-             hide_index=True)
-
-        df2 = pandas.DataFrame.from_dict([
-            {
-                'Week': ii,
-                **{s: fellows_for_shifts[s][ii] for s in ['NCC1', 'NCC2', 'Extra', 'Swing']},
-            }
-        for ii in range(W)])
-
-        st.dataframe(df2.style.applymap(lambda x: bg_color(x)), #[{'selector': 'MICU', 'props': 'background-color: #e6ffe6;'}]),
-             hide_index=True)
+    request = dict(
+        jr_fellows=jr_fellows,
+        sr_fellows=sr_fellows,
+        stroke_fellows=stroke_fellows,
+        CCM_fellows=CCM_fellows,
+        R=R,
+        fellow_week_pairs=vacation_requests,
+        rules=rules,
+        backend=backend,
+        timeout=time_limit,
+    )
+    if alternatives > 1:
+        kind = "alternatives"
+        request["n"] = alternatives
+    elif previous_workbook is not None:
+        kind = "repair"
+        request.update(previous=read_schedule(previous_workbook), from_week=from_week)
+    else:
+        kind = "optimize"
+    # the job outlives this run: later reruns pick it up from the session
+    st.session_state["job"] = (kind, job_pool().submit(kind, **request))
+
+if "job" in st.session_state:
+    kind, job_id = st.session_state["job"]
+    job = job_pool().status(job_id)
+    if job["state"] == "unknown":
+        # forgotten (too many jobs since), or the server restarted
+        del st.session_state["job"]
+    elif job["state"] == "failed":
+        st.error(f"The solver failed: {job['error']}")
+    elif kind == "alternatives":
+        # shown one by one as the solver finds them
+        schedules = job["result"] if job["state"] == "done" else job["partial"]
+        found = 0
+        for shifts_for_fellows, fellows_for_shifts, report in schedules:
+            if shifts_for_fellows is None:
+                show_failure(report)
+                break
+            found += 1
+            st.markdown(f"### Schedule {found}")
+            show_schedule(shifts_for_fellows, fellows_for_shifts)
+            if instrumentation:
+                show_profile(report)
+        if job["state"] == "done" and 0 < found < alternatives:
+            st.info(f"Only {found} sufficiently different schedules found.")
+    elif job["state"] == "done":
+        shifts_for_fellows, fellows_for_shifts, report = job["result"]
+        if shifts_for_fellows is None:
+            show_failure(report)
+        else:
+            if report.get("cached"):
+                st.caption("Solved before: this schedule is from the cache.")
+            if report.get("optimal") is False:
+                st.warning(f"Stopped at the {time_limit}s time limit; this is the best schedule found, not necessarily the best possible.")
+            if "changes" in report:
+                st.write(f"{len(report['changes'])} assignments changed: " +
+                         ", ".join(f"{fellow} week {w} {old or '-'} → {new or '-'}" for fellow, w, old, new in report["changes"]))
+            show_schedule(shifts_for_fellows, fellows_for_shifts)
+        if instrumentation:
+            show_profile(report)
 
+    if job["state"] in ("queued", "running"):
+        progress = job["progress"]
+        if job["state"] == "queued":
+            st.info("Waiting for a free solver...")
+        elif "objective" in progress:
+            st.info(f"{progress['elapsed']:.1f}s: best schedule so far violates soft rules at cost {progress['objective']}")
+        else:
+            st.info("Solving...")
+        time.sleep(1)
+        st.rerun()
 
 #     range_fellows_assigned_fully(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
 #     everyone_one_rotation_per_week(o, x, fellow_start=0, fellow_end=N)
@@ -0,0 +1,313 @@
+from z3 import *
+
+try:
+    from ortools.sat.python import cp_model
+except ImportError:  # optional: only needed for backend="cp-sat"
+    cp_model = None
+
+# Solver backends. The rules describe constraints in a few backend-neutral kinds
+# over literals (see cardinality.py), and ScheduleSolver hands each one to a
+# backend together with the literals it is conditional on (rule guards, soft
+# constraints' violation literals, tracking literals):
+#
+#   ("all", lits)                       every literal holds
+#   ("clause", lits)                    at least one holds (none given: False)
+#   ("at_least" | "at_most" | "exactly", lits, k)
+#   ("linear", lits, coeffs, lo, hi)    lo <= sum(c * l) <= hi (either may be None)
+#   ("equal", lits)                     all the same
+#   ("is_or", [b] + lits)               b == Or(lits)
+#   ("step", [b, p, q, l])              b -> p or (q and l); p and q may be the
+#                                       constants True/False (prefix_at_least)
+#
+# A backend also makes literals, checks under assumptions within a budget, gives
+# unsat cores, and reads values off the last solution. check() returns "sat" when
+# it has a solution, which in optimization may be the best found before the budget
+# ran out (then optimal is False); on_model, if set, is called at each improving
+# solution found during a check.
+
+
+def _bool_app(mk, lits, *extra):
+    # mk(ctx, n, args, ...) over lits, without z3's per-argument sort coercion,
+    # which dominates model construction: every literal here is already a Bool.
+    ctx = lits[0].ctx
+    args = (Ast * len(lits))(*[l.ast for l in lits])
+    return BoolRef(mk(ctx.ref(), len(lits), args, *extra), ctx)
+
+
+class Z3Backend:
+    # Wraps a z3 Solver, tactic solver or Optimize (see main.make_solver).
+
+    def __init__(self, solver):
+        self.solver = solver
+        self.model = None
+        self.optimal = False
+        self.on_model = None
+        if isinstance(solver, Optimize):
+            solver.set_on_model(self._improved)
+
+    def _improved(self, m):
+        self.model = m
+        if self.on_model is not None:
+            self.on_model()
+
+    def new_bool(self, name):
+        return Bool(name)
+
+    def neg(self, l):
+        if is_not(l):
+            return l.arg(0)
+        return BoolRef(Z3_mk_not(l.ctx.ref(), l.ast), l.ctx)
+
+    def key(self, l):
+        # the same for a variable and its negation
+        return l.arg(0).get_id() if is_not(l) else l.get_id()
+
+    def build(self, kind, lits, *params):
+        if kind in ("all", "clause") and len(lits) == 1:
+            return lits[0]
+        if kind == "all":
+            return _bool_app(Z3_mk_and, lits)
+        if kind == "clause":
+            return _bool_app(Z3_mk_or, lits) if lits else BoolVal(False)
+        if kind == "at_least":
+            return _bool_app(Z3_mk_atleast, lits, params[0])
+        if kind == "at_most":
+            return _bool_app(Z3_mk_atmost, lits, params[0])
+        if kind == "exactly":
+            return PbEq([(l, 1) for l in lits], params[0])
+        if kind == "linear":
+            coeffs, lo, hi = params
+            terms = list(zip(lits, coeffs))
+            bounds = ([PbGe(terms, lo)] if lo is not None else []) + ([PbLe(terms, hi)] if hi is not None else [])
+            return bounds[0] if len(bounds) == 1 else And(*bounds)
+        if kind == "equal":
+            return And(*[lits[0] == l for l in lits[1:]])
+        if kind == "is_or":
+            return lits[0] == _bool_app(Z3_mk_or, lits[1:])
+        if kind == "step":
+            b, p, q, l = [BoolVal(v) if isinstance(v, bool) else v for v in lits]
+            return Implies(b, Or(p, And(q, l)))
+        raise ValueError(f"Unknown constraint kind {kind!r}")
+
+    def post(self, kind, lits, params, conditions):
+        c = self.build(kind, lits, *params)
+        if conditions:
+            cond = conditions[0] if len(conditions) == 1 else _bool_app(Z3_mk_and, conditions)
+            c = BoolRef(Z3_mk_implies(c.ctx.ref(), cond.ast, c.ast), c.ctx)
+        self.solver.add(c)
+
+    def minimize(self, violated, weight, id):
+        # One objective for all soft rules, the total weight as with CP-SAT: with an
+        # id per rule z3 would minimize them one after another, in the order added.
+        self.solver.add_soft(Not(violated), weight)
+
+    def hint(self, lits, values):
+        # Ignored: z3's initial values would outlive pop(), and didn't make
+        # repairs any faster.
+        pass
+
+    def push(self):
+        self.solver.push()
+
+    def pop(self):
+        self.solver.pop()
+
+    def check(self, assumptions):
+        self.model = None
+        result = self.solver.check(*assumptions)
+        self.optimal = result == sat
+        if result == sat:
+            self.model = self.solver.model()
+        elif result == unknown and self.model is not None:
+            # out of budget, with the best schedule found so far
+            return "sat"
+        return str(result)
+
+    def core(self, assumptions):
+        used = {a.get_id() for a in self.solver.unsat_core()}
+        return [a for a in assumptions if a.get_id() in used]
+
+    def values(self, lits):
+        # Whether each literal holds in the last solution; unassigned variables
+        # count as False (model completion). Each distinct literal is evaluated
+        # once, straight through the C API.
+        ctx = self.model.ctx.ref()
+        result = (Ast * 1)()
+        values = {}
+        out = []
+        for l in lits:
+            key = l.get_id()
+            if key not in values:
+                Z3_model_eval(ctx, self.model.model, l.ast, True, result)
+                values[key] = Z3_get_bool_value(ctx, result[0]) == Z3_L_TRUE
+            out.append(values[key])
+        return out
+
+    def set_budget(self, ms=None, conflicts=None):
+        self.solver.set("timeout", 4294967295 if ms is None else max(1, int(ms)))
+        self.solver.set("max_conflicts", 4294967295 if conflicts is None else conflicts)
+
+    def statistics(self):
+        stats = self.solver.statistics()
+        return {k: stats.get_key_value(k) for k in stats.keys()}
+
+
+class CpSatBackend:
+    # OR-Tools CP-SAT. CP-SAT models aren't incremental: constraints posted at the
+    # top level go into one base model, and those posted after a push() are kept
+    # aside and added to a copy of it at each check.
+
+    def __init__(self, workers=None):
+        if cp_model is None:
+            raise ImportError("backend='cp-sat' needs OR-Tools (pip install ortools)")
+        self.model = cp_model.CpModel()
+        self.solver = cp_model.CpSolver()
+        if workers is not None:
+            self.solver.parameters.num_workers = workers
+        # constraints posted since each push()
+        self.scopes = []
+        # (violation literal, weight) of soft constraints, and its length at each push()
+        self.objective = []
+        # (literal, value) search hints, and how many there were at each push()
+        self.hints = []
+        self._marks = []
+        self.optimal = False
+        self.on_model = None
+        # where values() reads from: the solver, or a solution during a check
+        self._source = self.solver
+
+    def _improved(self, solution):
+        self._source = solution
+        try:
+            if self.on_model is not None:
+                self.on_model()
+        finally:
+            self._source = self.solver
+
+    def new_bool(self, name):
+        return self.model.NewBoolVar(name)
+
+    def neg(self, l):
+        return ~l
+
+    def key(self, l):
+        i = l.Index()
+        return i if i >= 0 else -i - 1
+
+    def _sum(self, lits, coeffs):
+        # sum(c * l) as a linear expression plus a constant, with negated
+        # literals ~v turned into 1 - v
+        expr, offset = [], 0
+        for l, c in zip(lits, coeffs):
+            if l.Index() < 0:
+                expr.append(-c * (~l))
+                offset += c
+            else:
+                expr.append(c * l)
+        return sum(expr), offset
+
+    def _post(self, model, kind, lits, params, conditions):
+        if kind == "all":
+            cs = [model.AddBoolAnd(lits)]
+        elif kind == "clause":
+            cs = [model.AddBoolOr(lits)]
+        elif kind in ("at_least", "at_most", "exactly"):
+            expr, offset = self._sum(lits, [1] * len(lits))
+            k = params[0] - offset
+            cs = [model.Add(expr >= k) if kind == "at_least" else
+                  model.Add(expr <= k) if kind == "at_most" else
+                  model.Add(expr == k)]
+        elif kind == "linear":
+            coeffs, lo, hi = params
+            expr, offset = self._sum(lits, coeffs)
+            total = sum(abs(c) for c in coeffs)
+            lo = -total if lo is None else lo
+            hi = total if hi is None else hi
+            cs = [model.AddLinearConstraint(expr, lo - offset, hi - offset)]
+        elif kind == "equal":
+            cs = [model.AddBoolOr([~lits[0], l]) for l in lits[1:]] + \
+                 [model.AddBoolOr([lits[0], ~l]) for l in lits[1:]]
+        elif kind == "is_or":
+            b, rest = lits[0], lits[1:]
+            cs = [model.AddBoolOr([~b] + rest)] + [model.AddBoolOr([~l, b]) for l in rest]
+        elif kind == "step":
+            b, p, q, l = lits
+            clauses = [[~b, p, q], [~b, p, l]]
+            cs = [model.AddBoolOr([v for v in c if v is not False]) for c in clauses
+                  if not any(v is True for v in c)]
+        else:
+            raise ValueError(f"Unknown constraint kind {kind!r}")
+        if conditions:
+            for c in cs:
+                c.OnlyEnforceIf(conditions)
+
+    def post(self, kind, lits, params, conditions):
+        if self.scopes:
+            self.scopes[-1].append((kind, lits, params, conditions))
+        else:
+            self._post(self.model, kind, lits, params, conditions)
+
+    def minimize(self, violated, weight, id):
+        self.objective.append((violated, weight))
+
+    def hint(self, lits, values):
+        # Start the search from these values (only a preference).
+        self.hints.extend(zip(lits, values))
+
+    def push(self):
+        self.scopes.append([])
+        self._marks.append((len(self.objective), len(self.hints)))
+
+    def pop(self):
+        self.scopes.pop()
+        objective, hints = self._marks.pop()
+        del self.objective[objective:]
+        del self.hints[hints:]
+
+    def check(self, assumptions):
+        model = self.model.Clone()
+        for scope in self.scopes:
+            for c in scope:
+                self._post(model, *c)
+        if self.objective:
+            model.Minimize(sum(w * v for v, w in self.objective))
+        for l, v in self.hints:
+            model.AddHint(l, v)
+        model.AddAssumptions(assumptions)
+        status = self.solver.Solve(model, _Improved(self))
+        # with an objective, FEASIBLE is the best found before the budget ran out
+        self.optimal = status == cp_model.OPTIMAL
+        if status in (cp_model.OPTIMAL, cp_model.FEASIBLE):
+            return "sat"
+        if status == cp_model.INFEASIBLE:
+            return "unsat"
+        return "unknown"
+
+    def core(self, assumptions):
+        used = set(self.solver.SufficientAssumptionsForInfeasibility())
+        return [a for a in assumptions if a.Index() in used]
+
+    def values(self, lits):
+        return [self._source.BooleanValue(l) for l in lits]
+
+    def set_budget(self, ms=None, conflicts=None):
+        parameters = self.solver.parameters
+        parameters.max_time_in_seconds = float("inf") if ms is None else ms / 1000
+        parameters.max_number_of_conflicts = 2 ** 63 - 1 if conflicts is None else conflicts
+
+    def statistics(self):
+        return {
+            "conflicts": self.solver.NumConflicts(),
+            "branches": self.solver.NumBranches(),
+            "wall time": self.solver.WallTime(),
+        }
+
+
+if cp_model is not None:
+    class _Improved(cp_model.CpSolverSolutionCallback):
+        def __init__(self, backend):
+            super().__init__()
+            self.backend = backend
+
+        def on_solution_callback(self):
+            self.backend._improved(self)
@@ -0,0 +1,220 @@
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import time
+
+import z3
+
+import main
+from backends import cp_model
+
+# Solver benchmarks: synthetic programs of a given shape, each solved from
+# scratch under every encoding / backend configuration, recording how long the
+# model takes to build and to solve, the peak memory, and the solver's own
+# statistics. Every case runs in a fresh process (so the memory figure is its
+# own, and a case that never finishes can be killed). Results are written as
+# JSON, and can be compared with an earlier run kept as the baseline:
+#
+#     python benchmark.py --suite scaling --out results.json --baseline baseline.json
+#
+# exits non-zero if a case got slower or lost its answer.
+
+# Solver configurations, as ScheduleModel settings; presolve=True builds the
+# model for the one request (see presolve.py).
+CONFIGS = [
+    {"encoding": "weekly", "backend": "z3"},
+    {"encoding": "block", "backend": "z3"},
+    {"encoding": "weekly", "backend": "z3", "presolve": True},
+]
+if cp_model is not None:
+    CONFIGS += [
+        {"encoding": "weekly", "backend": "cp-sat"},
+        {"encoding": "block", "backend": "cp-sat"},
+    ]
+
+# Programs to run, as synthetic_program arguments. "scaling" grows one
+# dimension at a time from the example program's shape, to see where the
+# model stops keeping up.
+SUITES = {
+    "quick": [{}],
+    "scaling": (
+        [{}]
+        + [{"ccm": n} for n in (30, 45, 60)]
+        + [{"stroke": n} for n in (8, 12)]
+        + [{"jr": n, "sr": n} for n in (3, 4)]
+        + [{"years": n} for n in (2, 3)]
+        + [{"vacations": n} for n in (0, 5, 8)]
+    ),
+}
+
+
+def synthetic_program(jr=2, sr=2, stroke=4, ccm=15, years=1, vacations=3, seed=0, rules=None):
+    # A program shaped like the example one: fellows by cohort, a horizon of
+    # years, and vacations requested weeks (random, after the first month) per
+    # NCC fellow, the first main.N_VAC of them vacation and the rest electives.
+    # rules switches rules off or changes them, as for optimize_schedule.
+    rng = random.Random(seed)
+    jr_fellows = [f"NCC jr {i}" for i in range(jr)]
+    sr_fellows = [f"NCC sr {i}" for i in range(sr)]
+    return {
+        "jr_fellows": jr_fellows,
+        "sr_fellows": sr_fellows,
+        "stroke_fellows": [f"Stroke {i}" for i in range(stroke)],
+        "CCM_fellows": [f"CCM {i}" for i in range(ccm)],
+        "R": ["NCC1", "NCC2", "Swing", "SICU", "MICU", "Elec", "Vac", "NS", "Vasc/Clin", "Anaesthesia"],
+        "fellow_week_pairs": {f: sorted(rng.sample(range(4, main.W), vacations)) for f in jr_fellows + sr_fellows},
+        "weeks": years * main.W,
+        "rules": rules,
+    }
+
+
+def _measure(program, config, timeout, results):
+    # In a fresh process: build the model for program under config, solve it
+    # (diagnosing it, if unsat), and put the measurements on results.
+    config = dict(config)
+    presolve = config.pop("presolve", False)
+    cohorts = [program[k] for k in ("jr_fellows", "sr_fellows", "stroke_fellows", "CCM_fellows", "R")]
+    start = time.perf_counter()
+    model = main.ScheduleModel(
+        *cohorts, weeks=program["weeks"],
+        presolve_for=(program["fellow_week_pairs"], program["rules"]) if presolve else None,
+        restricted=main.restricted_cohorts(program["rules"]),
+        **config,
+    )
+    build = time.perf_counter() - start
+    start = time.perf_counter()
+    _, _, report = model.solve(program["fellow_week_pairs"], program["rules"], timeout=timeout)
+    solve = time.perf_counter() - start
+    results.put({
+        "status": report["status"],
+        "build": build,
+        "solve": solve,
+        # ru_maxrss is in KiB on Linux
+        "peak_memory_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "cells": report["presolve"]["cells"],
+        "fixed": report["presolve"]["fixed"],
+        "statistics": report["statistics"],
+    })
+
+
+def measure(program, config, timeout=60, limit=None):
+    # The measurements for one case, or status "error" / "killed" if it raised
+    # or was still running limit seconds in (default: a minute past timeout,
+    # for building the model).
+    limit = timeout + 60 if limit is None else limit
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    p = context.Process(target=_measure, args=(program, config, timeout, results), daemon=True)
+    p.start()
+    deadline = time.monotonic() + limit
+    try:
+        while True:
+            try:
+                return results.get(timeout=1)
+            except queue.Empty:
+                if not p.is_alive():
+                    # it may have put its result on the way out
+                    try:
+                        return results.get(timeout=1)
+                    except queue.Empty:
+                        return {"status": "error", "exitcode": p.exitcode}
+                if time.monotonic() > deadline:
+                    return {"status": "killed"}
+    finally:
+        p.terminate()
+        p.join()
+
+
+def case_name(shape, config):
+    # e.g. "ccm=30 encoding=block backend=z3"
+    parts = [f"{k}={v}" for k, v in sorted(shape.items())] or ["example"]
+    return " ".join(parts + [f"{k}={v}" for k, v in config.items()])
+
+
+def run(shapes, configs=None, timeout=60, seed=0, progress=print):
+    # {case name: measurements} for every shape (synthetic_program arguments)
+    # under every config
+    results = {}
+    for shape in shapes:
+        program = synthetic_program(seed=seed, **shape)
+        for config in configs or CONFIGS:
+            name = case_name(shape, config)
+            results[name] = {"shape": shape, "config": config, **measure(program, config, timeout)}
+            if progress:
+                progress(_line(name, results[name]))
+    return results
+
+
+def _line(name, result):
+    if "solve" not in result:
+        return f"{name:60} {result['status']}"
+    return (f"{name:60} {result['status']:8} build {result['build']:6.2f}s  solve {result['solve']:7.2f}s  "
+            f"{result['peak_memory_mb']:7.0f} MB")
+
+
+def environment():
+    # what the timings depend on besides the code
+    return {
+        "rules_version": main.RULES_VERSION,
+        "python": platform.python_version(),
+        "z3": z3.get_version_string(),
+        "ortools": None if cp_model is None else _ortools_version(),
+        "machine": platform.machine(),
+        "cpus": os.cpu_count(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+
+
+def _ortools_version():
+    import ortools
+    return ortools.__version__
+
+
+def compare(results, baseline, tolerance=1.5, slack=0.5):
+    # Regressions against baseline results (both {case name: measurements}), as
+    # messages: a case that found a schedule (or proved there is none) in the
+    # baseline and doesn't now, or whose build or solve time grew past
+    # tolerance times the baseline's plus slack seconds (solve times on this
+    # model are noisy).
+    regressions = []
+    for name, old in baseline.items():
+        new = results.get(name)
+        if new is None:
+            continue
+        if old["status"] in ("sat", "unsat") and new["status"] != old["status"]:
+            regressions.append(f"{name}: {old['status']} -> {new['status']}")
+            continue
+        for key in ("build", "solve"):
+            if key in old and key in new and new[key] > old[key] * tolerance + slack:
+                regressions.append(f"{name}: {key} {old[key]:.2f}s -> {new[key]:.2f}s")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the scheduler on synthetic programs.")
+    parser.add_argument("--suite", choices=sorted(SUITES), default="quick")
+    parser.add_argument("--timeout", type=float, default=60, help="solver time limit per case (seconds)")
+    parser.add_argument("--seed", type=int, default=0, help="for the synthetic vacation requests")
+    parser.add_argument("--out", help="write the results to this JSON file")
+    parser.add_argument("--baseline", help="compare with the results in this JSON file")
+    parser.add_argument("--tolerance", type=float, default=1.5)
+    args = parser.parse_args()
+
+    results = run(SUITES[args.suite], timeout=args.timeout, seed=args.seed,
+                  progress=lambda line: print(line, flush=True))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump({"environment": environment(), "results": results}, f, indent=1)
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline["results"], args.tolerance)
+        for message in regressions:
+            print("REGRESSION", message)
+        if regressions:
+            raise SystemExit(1)
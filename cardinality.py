@@ -0,0 +1,220 @@
+# Every constraint in the rules goes through here, so that they don't depend on
+# the solver: each helper hands the solver `o` one of the constraint kinds in
+# backends.py over literals, which z3 sees as native pseudo-Boolean terms
+# (AtMost/AtLeast/PbEq/PbLe/PbGe) instead of Sum([If(b, 1, 0) ...]) integer
+# arithmetic, and CP-SAT as its own Boolean and linear constraints.
+#
+# Each helper takes the solver `o`, a list of literals and a bound, and adds the
+# constraint. `enforce` optionally names a literal that must hold for the
+# constraint to apply (i.e. we add Implies(enforce, constraint)).
+#
+# Besides solver literals, a literal may be a constant: True or False for a value
+# that is already known (a week scheduled earlier, see main.solve_rolling, or a
+# cell decided up front, see presolve.py), or
+# UNKNOWN for one left out of this model (a week past the window being solved).
+# Known values are folded into the constraint. Unknown ones may turn out either
+# way, so only what must hold whatever they are is kept: the constraint is
+# relaxed, never tightened.
+
+
+class _Unknown:
+    def __repr__(self):
+        return "UNKNOWN"
+
+# the value of a literal left out of the model
+UNKNOWN = _Unknown()
+
+
+def is_literal(l):
+    # a solver literal, not a constant
+    return l is not UNKNOWN and not isinstance(l, bool)
+
+
+def _split(lits):
+    # (solver literals, number of known-true literals, number of unknown ones)
+    free = [l for l in lits if is_literal(l)]
+    true = sum(1 for l in lits if l is True)
+    unknown = sum(1 for l in lits if l is UNKNOWN)
+    return free, true, unknown
+
+
+def require(o, lits, enforce=None):
+    # Every literal holds.
+    lits = list(lits)
+    if any(l is False for l in lits):
+        o.add("clause", [], enforce=enforce)
+        return
+    free, _, _ = _split(lits)
+    if free:
+        o.add("all", free, enforce=enforce)
+
+
+def clause(o, lits, enforce=None):
+    # At least one literal holds.
+    lits = list(lits)
+    if any(l is True or l is UNKNOWN for l in lits):
+        return
+    o.add("clause", [l for l in lits if l is not False], enforce=enforce)
+
+
+def implies(o, a, b, enforce=None):
+    clause(o, [o.neg(a), b], enforce)
+
+
+def at_least(o, lits, k, enforce=None):
+    lits, true, unknown = _split(lits)
+    # the unknown literals might all hold
+    k -= true + unknown
+    if k <= 0:
+        return
+    if k > len(lits):
+        o.add("clause", [], enforce=enforce)
+    elif k == 1:
+        o.add("clause", lits, enforce=enforce)
+    else:
+        o.add("at_least", lits, k, enforce=enforce)
+
+
+def at_most(o, lits, k, enforce=None):
+    lits, true, _ = _split(lits)
+    # the unknown literals might all be false
+    k -= true
+    if k >= len(lits):
+        return
+    if k < 0:
+        o.add("clause", [], enforce=enforce)
+    elif k == 0:
+        o.add("all", [o.neg(l) for l in lits], enforce=enforce)
+    else:
+        o.add("at_most", lits, k, enforce=enforce)
+
+
+def exactly(o, lits, k, enforce=None):
+    lits = list(lits)
+    if any(l is UNKNOWN for l in lits):
+        at_least(o, lits, k, enforce)
+        at_most(o, lits, k, enforce)
+        return
+    lits, true, _ = _split(lits)
+    k -= true
+    if k < 0 or k > len(lits):
+        o.add("clause", [], enforce=enforce)
+    elif not lits:
+        return
+    elif k == 0:
+        o.add("all", [o.neg(l) for l in lits], enforce=enforce)
+    elif k == len(lits):
+        o.add("all", lits, enforce=enforce)
+    else:
+        o.add("exactly", lits, k, enforce=enforce)
+
+
+def weighted_between(o, terms, lo, hi, enforce=None):
+    # lo <= sum(c * l for l, c in terms) <= hi, for integer (possibly negative) c.
+    terms = [(l, c) for l, c in terms if c != 0 and l is not False]
+    known = sum(c for l, c in terms if l is True)
+    # the range of the unknown literals' part of the sum
+    low = sum(c for l, c in terms if l is UNKNOWN and c < 0)
+    high = sum(c for l, c in terms if l is UNKNOWN and c > 0)
+    if lo is not None:
+        lo -= known + high
+    if hi is not None:
+        hi -= known + low
+    terms = [(l, c) for l, c in terms if is_literal(l)]
+    if not terms:
+        if (lo is not None and lo > 0) or (hi is not None and hi < 0):
+            o.add("clause", [], enforce=enforce)
+        return
+    lits, coeffs = [l for l, _ in terms], [c for _, c in terms]
+    if lo is not None:
+        o.add("linear", lits, coeffs, lo, None, enforce=enforce)
+    if hi is not None:
+        o.add("linear", lits, coeffs, None, hi, enforce=enforce)
+
+
+def all_or_none(o, lits, enforce=None):
+    # Either every literal holds or none does; chained equalities, no counting.
+    lits = list(lits)
+    free, _, _ = _split(lits)
+    if any(l is True for l in lits):
+        require(o, [l for l in lits if l is not UNKNOWN], enforce)
+    elif any(l is False for l in lits):
+        require(o, [o.neg(l) for l in free], enforce)
+    elif len(free) > 1:
+        o.add("equal", free, enforce=enforce)
+
+
+def _define_clause(o, lits):
+    # A clause that is part of a definition (so never soft), with constants.
+    if any(l is True or l is UNKNOWN for l in lits):
+        return
+    o.define("clause", [l for l in lits if l is not False])
+
+
+def equal_or(o, b, lits):
+    # Define b as Or(lits).
+    lits = [l for l in lits if l is not False]
+    if not lits or not is_literal(b) or not all(is_literal(l) for l in lits):
+        # b implies Or(lits), and each literal implies b
+        _define_clause(o, [o.neg(b)] + lits)
+        for l in lits:
+            _define_clause(o, [o.neg(l), b])
+        return
+    o.define("is_or", [b] + lits)
+
+
+def define_or(o, name, lits):
+    # A fresh literal equivalent to Or(lits), so that rules can share it instead
+    # of rebuilding the disjunction every time they count it; or Or(lits) itself
+    # if that is a constant (UNKNOWN if it depends on an unknown literal) or a
+    # single literal.
+    lits = [l for l in lits if l is not False]
+    if any(l is True for l in lits):
+        return True
+    if not lits:
+        return False
+    if all(l is UNKNOWN for l in lits):
+        return UNKNOWN
+    if len(lits) == 1:
+        return lits[0]
+    b = o.new_bool(name)
+    equal_or(o, b, lits)
+    return b
+
+
+def prefix_at_least(o, name, lits, n):
+    # Sequential (unary) counter over lits: returns c where c[i] implies "at least
+    # n of lits[:i] hold", for i in 0..len(lits). Uses up to len(lits) * n auxiliary
+    # literals with one "step" constraint each, so a rule that needs the running
+    # count at every position stays linear instead of re-summing each prefix.
+    # c[i] is the constant False while i < n.
+    #
+    # Only the implication is encoded (a counter bit may be false even when the
+    # count is reached), which is all a rule needs when it only ever requires c[i]
+    # to hold. It is also what keeps the search fast; the full equivalence made
+    # solve times on the example schedule wildly seed-dependent (and so, on z3, did
+    # splitting each step into two clauses).
+    #
+    # Counter bits that are known from constant literals are constants themselves
+    # (UNKNOWN where they depend on an unknown literal).
+    lits = list(lits)
+    prev = [True] + [False] * n
+    c = [prev[n]]
+    for i, l in enumerate(lits):
+        cur = [True]
+        for j in range(1, n + 1):
+            # b implies p or (q and l)
+            p, q = prev[j], prev[j - 1]
+            if p is True or (q is True and l is True):
+                b = True
+            elif p is False and (q is False or l is False):
+                b = False
+            elif p is UNKNOWN or (q is UNKNOWN and l is not False) or (l is UNKNOWN and q is not False):
+                b = UNKNOWN
+            else:
+                b = o.new_bool(f"{name}_{i}_{j}")
+                o.define("step", [b, p, q, l])
+            cur.append(b)
+        prev = cur
+        c.append(prev[n])
+    return c
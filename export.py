@@ -0,0 +1,145 @@
+import csv
+from datetime import date, timedelta
+
+import openpyxl
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import Border, PatternFill, Side
+
+from vacation_date_to_week_index import FIRST_DAY_OF_NCC_WEEKS
+
+# Writing schedules out: the workbook the scheduler has always produced (a
+# "Per-Fellow Schedule" sheet that read_schedule in main.py reads back, and an
+# "NCC Shift Schedule" sheet), and a flat table of assignments as CSV or Parquet
+# for other tools.
+#
+# The workbook is streamed: openpyxl's write-only mode, one row at a time, with
+# every border and fill built once up front and shared by all the cells that
+# use it. Any number of fellows (columns) and weeks (rows, for multi-year
+# schedules) work.
+
+START = date(*FIRST_DAY_OF_NCC_WEEKS)
+
+# cell colours, as in the app
+SHIFT_COLORS = {
+    "MICU": "B4C6E7",
+    "SICU": "FFE699",
+    "NCC1": "C6E0B4",
+    "NCC2": "C6E0B4",
+    "Swing": "A9D08E",
+    "Vasc/Clin": "FCE4D6",
+    "NS": "FFF3CC",
+    "Anaesthesia": "F8CBAD",
+}
+NCC_COLOR = "C6E0B4"
+STROKE_COLOR = "F8CBAD"
+CCM_COLOR = "B4C6E7"
+
+SHIFTS = ["NCC1", "NCC2", "Extra", "Swing"]
+
+
+def fellow_colors(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows):
+    # {fellow: colour}, by program, for the NCC Shift Schedule sheet
+    colors = {f: NCC_COLOR for f in jr_fellows + sr_fellows}
+    colors.update({f: STROKE_COLOR for f in stroke_fellows})
+    colors.update({f: CCM_COLOR for f in CCM_fellows})
+    return colors
+
+
+def _fills(colors):
+    # one PatternFill per colour, shared by every key with that colour
+    fills = {}
+    for color in set(colors.values()):
+        fills[color] = PatternFill(start_color=color, end_color=color, fill_type="solid")
+    return {key: fills[color] for key, color in colors.items()}
+
+
+def _borders(n):
+    # borders[row % 4][column] for a table n columns wide: a thick box around
+    # every four-week block
+    thick = Side(style="thick")
+    borders = []
+    for top, bottom in [(thick, None), (None, None), (None, None), (None, thick)]:
+        row = []
+        for c in range(n):
+            left = thick if c == 0 else None
+            right = thick if c == n - 1 else None
+            if top or bottom or left or right:
+                row.append(Border(top=top, bottom=bottom, left=left, right=right))
+            else:
+                row.append(None)
+        borders.append(row)
+    return borders
+
+
+def _text(value):
+    # a cell's value: a list of fellows (several on one shift) joined, "" as empty
+    if isinstance(value, (list, tuple)):
+        value = ", ".join(value)
+    return value or None
+
+
+def _write_sheet(wb, title, header, columns, fills, start):
+    # header names the columns (after Week); columns[c][w] is the value in
+    # column c for week w, and fills the fill for a value, if any.
+    ws = wb.create_sheet(title)
+    ws.append(["Week"] + list(header))
+    borders = _borders(len(columns))
+    weeks = len(columns[0]) if columns else 0
+    for w in range(weeks):
+        # the week's date, as a formula off the first so that it can be moved
+        first = WriteOnlyCell(ws, value=start if w == 0 else f"=A{w + 1}+7")
+        first.number_format = "YYYY-MM-DD"
+        row = [first]
+        for c, column in enumerate(columns):
+            cell = WriteOnlyCell(ws, value=_text(column[w]))
+            if borders[w % 4][c] is not None:
+                cell.border = borders[w % 4][c]
+            if cell.value in fills:
+                cell.fill = fills[cell.value]
+            row.append(cell)
+        ws.append(row)
+
+
+def write_workbook(filename, shifts_for_fellows, fellows_for_shifts, fellows=None, colors=None, start=START):
+    # filename (or a file object): the Per-Fellow Schedule of fellows (default:
+    # all of shifts_for_fellows; the scheduler writes just the NCC fellows) and
+    # the NCC Shift Schedule, with fellows coloured by colors (see
+    # fellow_colors). start is the date of week 0.
+    fellows = list(shifts_for_fellows) if fellows is None else fellows
+    wb = openpyxl.Workbook(write_only=True)
+    _write_sheet(wb, "Per-Fellow Schedule", fellows,
+                 [shifts_for_fellows[f] for f in fellows], _fills(SHIFT_COLORS), start)
+    _write_sheet(wb, "NCC Shift Schedule", SHIFTS,
+                 [fellows_for_shifts[s] for s in SHIFTS], _fills(colors or {}), start)
+    wb.save(filename)
+
+
+def assignments(shifts_for_fellows, start=START):
+    # The schedule as a flat table: a (week, date, fellow, rotation) row for
+    # every fellow-week, rotation "" for none.
+    for fellow, shifts in shifts_for_fellows.items():
+        for w, rotation in enumerate(shifts):
+            yield w, (start + timedelta(weeks=w)).isoformat(), fellow, rotation or ""
+
+
+COLUMNS = ["week", "date", "fellow", "rotation"]
+
+
+def write_csv(filename, shifts_for_fellows, start=START):
+    with open(filename, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow(COLUMNS)
+        writer.writerows(assignments(shifts_for_fellows, start))
+
+
+def write_parquet(filename, shifts_for_fellows, start=START):
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:  # optional, so not in requirements.txt: only needed for Parquet
+        raise ImportError("Parquet output needs pyarrow, which isn't installed (pip install pyarrow)") from None
+    rows = list(assignments(shifts_for_fellows, start))
+    table = pyarrow.table({
+        name: [row[i] for row in rows] for i, name in enumerate(COLUMNS)
+    })
+    pyarrow.parquet.write_table(table, filename)
@@ -0,0 +1,118 @@
+import multiprocessing
+import threading
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+
+from schedule_cache import fingerprint
+
+# Background solve jobs, for the app: one pool of solver processes per server,
+# shared by every session. submit() returns a job id straight away and the page
+# polls status() for progress and the result, so a solve neither blocks other
+# sessions nor dies with the script run that started it. The id is the request's
+# fingerprint (as in schedule_cache.py), so submitting the same request again,
+# from any session, joins the job already running (or finished) for it.
+#
+# Each job runs one of the solve functions in main; kind names it.
+KINDS = {
+    "optimize": "optimize_schedule",
+    "alternatives": "alternative_schedules",
+    "repair": "repair_schedule",
+}
+
+
+def _final(kind, kwargs, result):
+    # Whether a finished job's result is the answer for its request, rather than
+    # the best the time limit allowed: a schedule (an optimal one when
+    # optimizing) or unsat, as optimize_schedule's cache has it. Alternatives are
+    # final if there is none, or all n of them came back.
+    if kind == "alternatives":
+        return (len(result) == kwargs.get("n", 3)
+                or (len(result) == 1 and result[0][0] is None and result[0][2]["status"] == "unsat"))
+    report = result[2]
+    return report["status"] == "unsat" or (report["status"] == "sat" and report.get("optimal", True))
+
+
+def _run(kind, kwargs, progress, partial):
+    # In a worker process: progress (a shared dict) hears the solver's progress
+    # reports, and partial (a shared list) gets each alternative schedule as it
+    # is found. Returns what the solve function does (alternatives: as a list).
+    import main
+
+    def report(info):
+        progress.update({k: info[k] for k in ("elapsed", "objective") if k in info})
+
+    solve = getattr(main, KINDS[kind])
+    if kind != "alternatives":
+        return solve(**kwargs, progress=report)
+    for result in solve(**kwargs, progress=report):
+        partial.append(result)
+    return list(partial)
+
+
+class JobPool:
+    # processes solver processes (default: one per core). Finished jobs are kept,
+    # up to keep of them, so that their results outlive reruns; optimize jobs
+    # also go through cache (a ScheduleCache) if given.
+
+    def __init__(self, processes=None, keep=100, cache=None):
+        # spawn rather than fork: the Streamlit server is multithreaded
+        context = multiprocessing.get_context("spawn")
+        self.executor = ProcessPoolExecutor(max_workers=processes, mp_context=context)
+        self.manager = context.Manager()
+        self.keep = keep
+        self.cache = cache
+        self.lock = threading.Lock()
+        # job id -> (future, progress, partial), oldest first
+        self.jobs = OrderedDict()
+
+    def submit(self, kind, **kwargs):
+        # Start a job for kind with these arguments (anything JSON can encode),
+        # unless one for the same request is already running or has its final
+        # answer (see _final; a timed-out one is solved again), and return its id.
+        if kind not in KINDS:
+            raise ValueError(f"Unknown job kind {kind!r}, expected one of {sorted(KINDS)}")
+        job_id = fingerprint(kind, kwargs)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            if job is not None:
+                future = job[0]
+                if not future.done() or (future.exception() is None and _final(kind, kwargs, future.result())):
+                    return job_id
+                del self.jobs[job_id]
+            if kind == "optimize" and self.cache is not None:
+                kwargs = {**kwargs, "cache": self.cache}
+            progress, partial = self.manager.dict(), self.manager.list()
+            future = self.executor.submit(_run, kind, kwargs, progress, partial)
+            self.jobs[job_id] = (future, progress, partial)
+            self._forget()
+        return job_id
+
+    def status(self, job_id):
+        # {"state": "queued" | "running" | "done" | "failed" | "unknown",
+        #  "progress": the latest progress report, "partial": alternatives so far,
+        #  "result": what the solve function returned, once done, "error": if failed}
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return {"state": "unknown"}
+        future, progress, partial = job
+        status = {"progress": dict(progress), "partial": list(partial)}
+        if not future.done():
+            status["state"] = "running" if future.running() else "queued"
+        elif future.exception() is not None:
+            status["state"] = "failed"
+            status["error"] = repr(future.exception())
+        else:
+            status["state"] = "done"
+            status["result"] = future.result()
+        return status
+
+    def _forget(self):
+        # drop the oldest finished jobs beyond keep
+        finished = [job_id for job_id, (future, _, _) in self.jobs.items() if future.done()]
+        for job_id in finished[:max(0, len(finished) - self.keep)]:
+            del self.jobs[job_id]
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+        self.manager.shutdown()
@@ -0,0 +1,183 @@
+import multiprocessing
+import random
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+import main
+from validator import Validator, schedule_matrix
+
+# Large-neighbourhood search: improve a schedule a piece at a time. Free a small
+# part of it (a neighbourhood), re-solve just that part in "optimize" mode with
+# every other fellow-week fixed as it is, and keep the result if the whole
+# schedule scores better (by the validator, see validator.py). Repeat with
+# random neighbourhoods until the time budget runs out. Each re-solve is a
+# fraction of the whole model, so it finishes where a solve of everything at
+# once would still be searching, and it reuses the compiled model (see
+# ScheduleModel.solve_rotation's free).
+#
+# The neighbourhoods:
+#   "block"  every fellow, over a window of consecutive 4-week blocks
+#   "cohort" every fellow of one cohort (junior, senior, stroke, CCM), all weeks
+#   "pair"   two fellows of the same cohort, all weeks (so they can swap)
+NEIGHBORHOODS = ["block", "cohort", "pair"]
+
+
+def neighborhood(kind, rng, cohorts, weeks, blocks=2):
+    # (name, fellow indices, weeks) of a random neighbourhood of this kind, or
+    # None if the program has none; cohorts is [(name, fellow indices)].
+    cohorts = [(name, members) for name, members in cohorts if members]
+    if kind == "block":
+        width = min(weeks, 4 * blocks)
+        start = 4 * rng.randrange((weeks - width) // 4 + 1)
+        fellows = [f for _, members in cohorts for f in members]
+        return f"weeks {start}-{start + width - 1}", fellows, range(start, start + width)
+    if kind == "cohort":
+        name, members = rng.choice(cohorts)
+        return name, members, range(weeks)
+    if kind == "pair":
+        pairs = [(name, members) for name, members in cohorts if len(members) >= 2]
+        if not pairs:
+            return None
+        name, members = rng.choice(pairs)
+        fellows = sorted(rng.sample(members, 2))
+        return f"{name} {fellows[0]}+{fellows[1]}", fellows, range(weeks)
+    raise ValueError(f"Unknown neighbourhood {kind!r}, expected one of {NEIGHBORHOODS}")
+
+
+def _solve(settings, rotation, free, timeout):
+    # Re-solve the neighbourhood free of rotation (in this process or a pool's,
+    # either way with the model compiled once per process): the new rotation
+    # matrix, or None, and the solver status.
+    model = main.schedule_model(**settings["model"])
+    result, report = model.solve_rotation(
+        settings["fellow_week_pairs"], settings["rules"], timeout=timeout,
+        previous={f: list(row) for f, row in enumerate(rotation)}, free=free,
+    )
+    return result, report["status"]
+
+
+def improve_schedule(
+    jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+    start=None, soft_rules=None, rules=None, encoding="weekly", backend="z3", weeks=main.W,
+    timeout=60, neighborhood_timeout=5, neighborhoods=NEIGHBORHOODS, blocks=2,
+    processes=1, seed=0, progress=None,
+):
+    """
+    Improve a schedule by large-neighbourhood search: start (shifts_for_fellows
+    of every fellow, as optimize_schedule returns it, or a fellow x week
+    rotation matrix; by default a schedule found in "feasibility" mode) is
+    re-solved one random neighbourhood at a time (see NEIGHBORHOODS; a
+    "block" window is blocks 4-week blocks wide), each within
+    neighborhood_timeout seconds, keeping every change that lowers the
+    total cost, until timeout seconds have passed in all or the cost is 0.
+
+    The cost is what "optimize" mode minimizes: each uncovered swing week
+    costs 1 and each violation of a rule in soft_rules its weight. A start
+    that breaks hard rules is repaired too, where a neighbourhood covers
+    the violations (each costs validator.HARD_WEIGHT).
+
+    processes > 1 re-solves that many neighbourhoods at once, in a pool of
+    processes; each result is merged into the current schedule (the cells
+    it changed) and kept if the merged schedule scores better.
+
+    progress(info) is called with info["elapsed"] and info["objective"]
+    (the cost) at each improvement. rules, encoding, backend and weeks are
+    as for optimize_schedule.
+
+    Returns shifts_for_fellows, fellows_for_shifts and a report with the
+    cost, the violations per rule, and report["lns"] listing each
+    neighbourhood tried as (seconds in, neighbourhood, solver status, cost
+    after).
+    """
+    fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
+    began = time.monotonic()
+
+    def remaining():
+        return max(0, timeout - (time.monotonic() - began))
+
+    if start is None:
+        start, _, report = main.optimize_schedule(
+            jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+            soft_rules=soft_rules, rules=rules, encoding=encoding, backend=backend, weeks=weeks, timeout=remaining(),
+        )
+        if start is None:
+            report["lns"] = []
+            return None, None, report
+    if isinstance(start, dict):
+        start = schedule_matrix(start, fellows, R)
+    rotation = np.array(start, dtype=int)
+
+    validator = Validator(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs, rules)
+    costs = {**(soft_rules or {}), "swing_coverage": 1}
+    cost = int(validator.score(rotation, costs))
+
+    n = [len(jr_fellows), len(sr_fellows), len(stroke_fellows), len(CCM_fellows)]
+    offsets = np.cumsum([0] + n)
+    cohorts = [(name, list(range(offsets[i], offsets[i + 1])))
+               for i, name in enumerate(["jr", "sr", "stroke", "CCM"])]
+    kinds = [kind for kind in neighborhoods if neighborhood(kind, random.Random(), cohorts, weeks, blocks)]
+    rng = random.Random(seed)
+    settings = {
+        "model": dict(jr_fellows=jr_fellows, sr_fellows=sr_fellows, stroke_fellows=stroke_fellows,
+                      CCM_fellows=CCM_fellows, R=R, mode="optimize", soft_rules=soft_rules,
+                      encoding=encoding, backend=backend, weeks=weeks, restricted=main.restricted_cohorts(rules, soft_rules)),
+        "fellow_week_pairs": fellow_week_pairs,
+        "rules": rules,
+    }
+    history = []
+
+    def attempt():
+        name, free_fellows, free_weeks = neighborhood(rng.choice(kinds), rng, cohorts, weeks, blocks)
+        return name, rotation.copy(), (free_fellows, list(free_weeks))
+
+    def merge(name, base, result, status):
+        # Keep result's changes to base if the schedule they make is better.
+        nonlocal rotation, cost
+        if result is not None:
+            merged = rotation.copy()
+            changed = result != base
+            merged[changed] = result[changed]
+            merged_cost = int(validator.score(merged, costs))
+            if merged_cost < cost:
+                rotation, cost = merged, merged_cost
+                if progress:
+                    progress({"elapsed": time.monotonic() - began, "objective": cost})
+        history.append((round(time.monotonic() - began, 3), name, status, cost))
+
+    def searching():
+        # until the budget runs out, or nothing is left to improve
+        return bool(kinds) and cost > 0 and remaining() > 0
+
+    if processes is None or processes <= 1:
+        while searching():
+            name, base, free = attempt()
+            result, status = _solve(settings, base, free, min(neighborhood_timeout, remaining()))
+            merge(name, base, result, status)
+    elif searching():
+        # spawn rather than fork, as for the app's job pool
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(max_workers=processes, mp_context=context) as executor:
+            running = {}
+            while running or searching():
+                while len(running) < processes and searching():
+                    name, base, free = attempt()
+                    future = executor.submit(_solve, settings, base, free, min(neighborhood_timeout, remaining()))
+                    running[future] = (name, base)
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name, base = running.pop(future)
+                    merge(name, base, *future.result())
+
+    shifts_for_fellows, fellows_for_shifts = main.extract_schedule(rotation, fellows, R)
+    violations = validator.violations(rotation)
+    report = {
+        "status": "sat",
+        "cost": cost,
+        "violations": {name: int(v) for name, v in violations.items() if v},
+        "valid": validator.valid(rotation),
+        "elapsed": time.monotonic() - began,
+        "lns": history,
+    }
+    return shifts_for_fellows, fellows_for_shifts, report
@@ -1,84 +1,145 @@
-from typing import List, Dict
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Dict, Optional
 
 from z3 import *
+import numpy as np
 import openpyxl
 
+from backends import Z3Backend, CpSatBackend
+from schedule_solver import ScheduleSolver, rule
+from symmetry import fellow_classes, break_symmetries
+from cardinality import is_literal, require, implies, at_least, at_most, exactly, weighted_between, all_or_none, equal_or, define_or, prefix_at_least
+from variable_store import VariableStore
+from presolve import presolve
+from schedule_cache import ScheduleCache
+from export import write_workbook, fellow_colors
 from vacation_date_to_week_index import vacation_date_to_week_index
-
-# Not too dangerous to make global
+# the modules defining the model, for RULES_VERSION
+import backends, cardinality, schedule_solver, symmetry, variable_store
+import presolve as presolve_module
+
+# Cached schedules (see schedule_cache.py) only answer the model that made them,
+# so their fingerprint includes every module the model is defined by: the rules
+# here, and how they are encoded, presolved and solved.
+_version = hashlib.sha256()
+for _module in [__file__] + [m.__file__ for m in (backends, cardinality, presolve_module, schedule_solver, symmetry, variable_store)]:
+    with open(_module, "rb") as _source:
+        _version.update(_source.read())
+RULES_VERSION = _version.hexdigest()
+
+# Not too dangerous to make global: the weeks in an academic year. A model may
+# cover several years (its x.W weeks); the yearly rules then apply to each.
 W = 52
 
+def years(x):
+    # the first week of each academic year in x
+    return range(0, x.W, W)
+
+# Derived "rotations": groups of rotations that the rules count together. Each
+# gets one auxiliary Bool per fellow-week (see derived_rotations), stored in x
+# alongside the real rotations.
+NICU = "NCC1|NCC2"
+NCC_ISH = "NCC1|NCC2|Swing"
+CORE_ICU = "NCC1|NCC2|Swing|SICU|MICU"
+DERIVED = [NICU, NCC_ISH, CORE_ICU]
+
+def derived_rotations(o, x, N, ncc_block=1):
+    # With ncc_block > 1 (block encoding, see block_variables) every week of an
+    # NCC block shares one NCC-ish Bool, defined by each of its weeks.
+    for f in range(N):
+        ncc1, ncc2, swing, sicu, micu = (x.weeks(f, r) for r in ["NCC1", "NCC2", "Swing", "SICU", "MICU"])
+        nccish = None
+        for w in range(x.W):
+            nicu = x[f, w, NICU] = define_or(o, f"nicu_{f}_{w}", [ncc1[w], ncc2[w]])
+            if w % ncc_block == 0:
+                nccish = define_or(o, f"nccish_{f}_{w}", [nicu, swing[w]])
+            else:
+                equal_or(o, nccish, [nicu, swing[w]])
+            x[f, w, NCC_ISH] = nccish
+            x[f, w, CORE_ICU] = define_or(o, f"icu_{f}_{w}", [nccish, sicu[w], micu[w]])
+
+def block_variables(x, blocked):
+    # Block encoding of blocked rotations: one Bool per fellow-block, shared by the
+    # weeks of the block, instead of one per week held together by the *_blocked
+    # rules. blocked lists (rotation, fellows, weeks per block, weeks that move
+    # together at the start of a block). NS is the odd one: its first three weeks
+    # are one variable and the fourth is its own, only allowed with them (ns_blocked).
+    for r, fellows, granularity, shared in blocked:
+        for f in fellows:
+            for w in range(0, x.W, granularity):
+                for w_ in range(w + 1, w + shared):
+                    x[f, w_, r] = x[f, w, r]
+
+@rule
 def range_fellows_assigned_fully(o, x, R, fellow_start, fellow_end):
     # Each NCC fellow has exactly one rotation per week, because we are responsible for their scheduleo.
     for f in range(fellow_start, fellow_end):
-        for w in range(W):
-            o.add(AtLeast(*[x[f, w, r] for r in R], 1))
+        for w in range(x.W):
+            at_least(o, x.week(f, w, R), 1)
 
 
+@rule
 def everyone_one_rotation_per_week(o, x, R, fellow_start, fellow_end):
     # Each other fellow has at most one rotation per week, since we are only assigning their NCC time.
     for f in range(fellow_start, fellow_end):
-        for w in range(W):
-            o.add(AtMost(*[x[f, w, r] for r in R], 1))
+        for w in range(x.W):
+            at_most(o, x.week(f, w, R), 1)
 
 
+@rule
 def ncc_shifts_covered_swing_deficit(o, x, N, deficit):
     # There is one fellow on Swing and at least one fellow on NCC1, NCC2 per week.
     # We can be more specific if this gets nuts with overassignment.
-    for w in range(W):
-        o.add(Sum([If(x[f, w, "NCC1"], 1, 0) for f in range(N)]) >= 1)
-        o.add(Sum([If(x[f, w, "NCC2"], 1, 0) for f in range(N)]) >= 1)
-        o.add(Sum([If(x[f, w, "NCC1"], 1, 0) for f in range(N)]) <= 2)
-        o.add(Sum([If(x[f, w, "NCC2"], 1, 0) for f in range(N)]) <= 2)
+    for w in range(x.W):
+        at_least(o, x.fellows(w, "NCC1", 0, N), 1)
+        at_least(o, x.fellows(w, "NCC2", 0, N), 1)
+        at_most(o, x.fellows(w, "NCC1", 0, N), 2)
+        at_most(o, x.fellows(w, "NCC2", 0, N), 2)
         # At most one extra fellow on at once.
-        o.add(Sum([If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"]), 1, 0) for f in range(N)]) <= 3)
+        at_most(o, x.fellows(w, NICU, 0, N), 3)
 
         # LE because inadequacy
-        o.add(Sum([If(x[f, w, "Swing"], 1, 0) for f in range(N)]) <= 1)
+        at_most(o, x.fellows(w, "Swing", 0, N), 1)
 
     # Ah, we might not actually have enough swing. Let's say at most 8 weeks are
-    # unassigned.
-    o.add(Sum([
-        Sum([If(x[f, w, "Swing"], 1, 0) for f in range(N)])
-        for w in range(W)]) >= W-deficit)
+    # unassigned (each year).
+    for y in years(x):
+        at_least(o, [v for f in range(N) for v in x.weeks(f, "Swing", y, y + W)], W-deficit)
 
+@rule
 def ncc_stroke_oversight(o, x, fellow_start, fellow_end):
     # IDEALLY every week either NCC1 or NCC2 is neurocrit or stroke.
-    for w in range(W):
-        o.add(
-            Sum([
-                If(
-                    Or(x[f, w, "NCC1"], x[f, w, "NCC2"]),
-                    1,
-                    0
-                ) for f in range(fellow_start, fellow_end)
-            ]) >= 1
-        )
+    for w in range(x.W):
+        at_least(o, x.fellows(w, NICU, fellow_start, fellow_end), 1)
 
+@rule
 def maximum_consecutive_icu_shifts(o, x, fellow_start, fellow_end, MAX_CONSEC):
 
     for f in range(fellow_start, fellow_end):
-        for w in range(W - MAX_CONSEC):
+        icu = x.weeks(f, CORE_ICU)
+        for w in range(x.W - MAX_CONSEC):
             # for r in ["NCC1", "NCC2", "Swing", "SICU", "MICU"]:
             #     o.add(Sum([If(x[f, w + i, r], 1, 0) for i in range(MAX_CONSEC + 1)]) <= MAX_CONSEC)
-            o.add(Sum([If(
-                Or(*[x[f, w + i, r] for r in ["NCC1", "NCC2", "Swing", "SICU", "MICU"]]),
-                1,
-                0) for i in range(MAX_CONSEC + 1)]) <= MAX_CONSEC)
+            at_most(o, icu[w:w + MAX_CONSEC + 1], MAX_CONSEC)
 
+@rule
 def jr_first_month_micu(o, x, fellow_start, fellow_end):
     # jr fellows first month is MICU
     for f in range(fellow_start, fellow_end):
-        for w in range(4):
-            o.add(x[f, w, "MICU"])
+        for y in years(x):
+            require(o, x.weeks(f, "MICU", y, y + 4))
 
-def jr_ncc_before_19(o, x, fellow_start, fellow_end):
-    # jr fellows have a block of NCC before week 19
+@rule
+def jr_ncc_before_19(o, x, fellow_start, fellow_end, last_week=19):
+    # jr fellows have a block of NCC before week 19 (or last_week)
     for f in range(fellow_start, fellow_end):
-        o.add(
-            Sum([If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"]), 1, 0) for w in range(4, 19)]) >= 1
-        )
+        for y in years(x):
+            at_least(o, x.weeks(f, NICU, y + 4, y + last_week), 1)
 
+@rule
 def ccm_total_service(o, x, fellow_start, fellow_end):
     # ccm fellows have precisely one month of NCC, of which one week is swing
     # TODO: follow 'block' boundaries
@@ -87,120 +148,94 @@ def ccm_total_service(o, x, fellow_start, fellow_end):
         # actually to do this, it's just as easy to do blocks
 
         # Total for the year
-        o.add(Sum([If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"]), 1, 0) for w in range(52)]) == 3)
-        o.add(Sum([If(x[f, w, "Swing"], 1, 0) for w in range(52)]) == 1)
+        for y in years(x):
+            exactly(o, x.weeks(f, NICU, y, y + W), 3)
+            exactly(o, x.weeks(f, "Swing", y, y + W), 1)
 
         # Consecutivity
-        for w in range(0, W, 4):
-            # If the first week of the block is NCC-ish, the rest must be.
-            # Oh no that is insane logic. Either all or none of the block is NCC-ish.
-            o.add(
-                If(
-                    Sum([If(Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"], x[f, w_, "Swing"]), 1, 0) for w_ in range(w, w + 4)]) > 0,
-                    Sum([If(Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"], x[f, w_, "Swing"]), 1, 0) for w_ in
-                         range(w, w + 4)]),
-                    4) == 4 # if the whole block isn't NCCish, this doesn't fail condition
-            )
-            o.add(
-                If(
-                    Sum([If(Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"], x[f, w_, "Swing"]), 1, 0) for w_ in
-                         range(w, w + 4)]) > 0,
-                    Sum([If(x[f, w_, "Swing"], 1, 0) for w_ in
-                         range(w, w + 4)]),
-                    1) == 1  # if the whole block isn't NCCish, this doesn't fail condition
-            )
+        for w in range(0, x.W, 4):
+            # Either all or none of the block is NCC-ish.
+            all_or_none(o, x.weeks(f, NCC_ISH, w, w + 4))
+            # and an NCC-ish block has exactly one swing week in it.
+            exactly(o, x.weeks(f, "Swing", w, w + 4), 1, enforce=x[f, w, NCC_ISH])
 
 def total_shift_service(o, x, f, shift, n):
-    o.add(Sum([If(x[f, w, shift], 1, 0) for w in range(W)]) >= n)
+    for y in years(x):
+        at_least(o, x.weeks(f, shift, y, y + W), n)
 
 def total_nicu_service(o, x, f, n):
-    o.add(Sum([If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"]), 1, 0) for w in range(W)]) >= n)
+    total_shift_service(o, x, f, NICU, n)
 
+@rule
 def stroke_total_service(o, x, fellow_start, fellow_end):
     for f in range(fellow_start, fellow_end):
         total_shift_service(o, x, f, "Swing", 2)
         total_nicu_service(o, x, f, 6)
 
+# Weeks per year of each rotation for the NCC fellows, by cohort. A cohort is
+# never on a rotation it has 0 weeks of (see fellow_rotations): the quotas add
+# up to the whole year anyway.
+JR_QUOTAS = {
+    "MICU": 20,
+    "Anaesthesia": 4,
+    "Elec": 9,
+    "Vac": 3,
+    "NS": 0,
+    "SICU": 4,
+    "Vasc/Clin": 0,
+    "Swing": 3,  # not sure how this was 6 TODO
+    NICU: 9,
+}
+SR_QUOTAS = {
+    "MICU": 8,
+    "Anaesthesia": 0,
+    "Elec": 10,
+    "Vac": 3,
+    "NS": 7,
+    "SICU": 0,
+    "Vasc/Clin": 4,
+    "Swing": 6,
+    NICU: 14,
+}
+
+# The stroke and CCM fellows only get their NCC time scheduled here (and their
+# vacation requests).
+NCC_TIME = ["NCC1", "NCC2", "Swing", "Vac", "Elec"]
+
+def fellow_rotations(R, quotas=None):
+    # The rotations of R that a fellow is ever on: those of their cohort's quotas
+    # that aren't 0, or their NCC time if we don't schedule them fully.
+    if quotas is None:
+        return [r for r in R if r in NCC_TIME]
+    return [r for r in R if quotas.get(r) != 0]
+
+@rule
 def ncc_jr_total_service(o, x, fellow_start, fellow_end):
     for f in range(fellow_start, fellow_end):
-        total_shift_service(o, x, f, "MICU", 20)
-        total_shift_service(o, x, f, "Anaesthesia", 4)
-        total_shift_service(o, x, f, "Elec", 9)
-        total_shift_service(o, x, f, "Vac", 3)
-        total_shift_service(o, x, f, "NS", 0)
-        total_shift_service(o, x, f, "SICU", 4)
-        total_shift_service(o, x, f, "Vasc/Clin", 0)
-        total_shift_service(o, x, f, "Swing", 3) # not sure how this was 6 TODO
-        total_nicu_service(o, x, f, 9)
-
-def ncc_jr_total_service(o, x, fellow_start, fellow_end):
-    for f in range(fellow_start, fellow_end):
-        total_shift_service(o, x, f, "MICU", 20)
-        total_shift_service(o, x, f, "Anaesthesia", 4)
-        total_shift_service(o, x, f, "Elec", 9)
-        total_shift_service(o, x, f, "Vac", 3)
-        total_shift_service(o, x, f, "NS", 0)
-        total_shift_service(o, x, f, "SICU", 4)
-        total_shift_service(o, x, f, "Vasc/Clin", 0)
-        total_shift_service(o, x, f, "Swing", 3)  # not sure how this was 6 TODO
-        total_nicu_service(o, x, f, 9)
+        for shift, n in JR_QUOTAS.items():
+            total_shift_service(o, x, f, shift, n)
 
+@rule
 def ncc_sr_total_service(o, x, fellow_start, fellow_end):
     for f in range(fellow_start, fellow_end):
-        total_shift_service(o, x, f, "MICU", 8)
-        total_shift_service(o, x, f, "Anaesthesia", 0)
-        total_shift_service(o, x, f, "Elec", 10)
-        total_shift_service(o, x, f, "Vac", 3)
-        total_shift_service(o, x, f, "NS", 7)
-        total_shift_service(o, x, f, "SICU", 0)
-        total_shift_service(o, x, f, "Vasc/Clin", 4)
-        total_shift_service(o, x, f, "Swing", 6)
-        total_nicu_service(o, x, f, 14)
-        pass
-
-# def Min(arg):
-#     return If(
-#         len(arg) == 0,
-#         arg[0],
-#         If(
-#             arg[0] > arg[1],
-#             Min(arg[1:]),
-#             Min(arg[0]+arg[2:])))
+        for shift, n in SR_QUOTAS.items():
+            total_shift_service(o, x, f, shift, n)
 
+@rule
 def jr_fellows_n_ncc_before_swing(o, x, fellow_start, fellow_end, n):
     # jr fellows have 4x NCC before their first swing
-    # Or(x[f, w, "NCC1"], x[f, w, "NCC2"]),
-
+    # Equivalently: every swing week has at least n NCC weeks before it, and there
+    # is a swing week at all. The running NCC count is shared across weeks, so this
+    # is linear in W.
+    if n <= 0:
+        return
     for f in range(fellow_start, fellow_end):
-        o.add(
-            Sum([
-                Product([
-                    # Number of NCC shifts before week w.
-                    Sum([
-                        If(
-                            Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"]),
-                            1,
-                            0
-                        )
-                    for w_ in range(w)]),
-                    # Zero if there is a swing shift before week w, or if week w itself is not a swing shift.
-                    If(
-                        And(
-                            Sum([
-                                If(
-                                    x[f, w_, "Swing"],
-                                    1,
-                                    0
-                                ) for w_ in range(w)
-                            ]) == 0,
-                            x[f,w,"Swing"],
-                        ),
-                        1,
-                        0
-                    )
-                ])
-            for w in range(W)]) >= n
-        )
+        for y in years(x):
+            enough_ncc_before = prefix_at_least(o, f"nccbefore_{f}_{y}", x.weeks(f, NICU, y, y + W), n)
+            swing = x.weeks(f, "Swing", y, y + W)
+            for w in range(W):
+                implies(o, swing[w], enough_ncc_before[w])
+            at_least(o, swing, 1)
 
 def shift_blocked(o, x, shift, fellow_min, fellow_max, GRANULARITY):
     # junior fellows have 4 sicu, and it should follow a block.
@@ -208,40 +243,36 @@ def shift_blocked(o, x, shift, fellow_min, fellow_max, GRANULARITY):
 
     for f in range(fellow_min, fellow_max):
         # Consecutivity
-        for w in range(0, W, GRANULARITY):
+        for w in range(0, x.W, GRANULARITY):
             # Either all or none of the block is SICU.
-            o.add(
-                Or(
-                    Sum([
-                        If(x[f, w_, shift], 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == GRANULARITY,
-                    Sum([
-                        If(x[f, w_, shift], 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == 0,
-                )
-            )
+            all_or_none(o, x.weeks(f, shift, w, w + GRANULARITY))
 
+@rule
 def sicu_blocked(o, x, fellow_start, fellow_end):
     # junior fellows have 4 sicu, and it should follow a block.
     # TODO: for now we are requiring 4 block
     shift_blocked(o, x, "SICU", fellow_start, fellow_end, GRANULARITY = 4)
 
+@rule
 def micu_blocked(o, x, fellow_start, fellow_end):
     # jr and sr fellows have lots of micu, and it should follow a block.
     # TODO: for now we are requiring 2 block
     shift_blocked(o, x, "MICU", fellow_start, fellow_end, GRANULARITY = 2)
 
 
+@rule
 def anaesthesia_blocked(o, x, fellow_start, fellow_end):
     # jr and sr fellows have lots of micu, and it should follow a block.
     # TODO: for now we are requiring 4 block
     shift_blocked(o, x, "Anaesthesia", fellow_start, fellow_end, GRANULARITY = 4)
 
+@rule
 def vasc_blocked(o, x, fellow_start, fellow_end):
     # jr and sr fellows have lots of micu, and it should follow a block.
     # TODO: for now we are requiring 4 block
     shift_blocked(o, x, "Vasc/Clin", fellow_start, fellow_end, GRANULARITY = 4)
 
+@rule
 def ns_blocked(o, x, fellow_start, fellow_end):
     # jr and sr fellows have lots of micu, and it should follow a block.
     # TODO: for now we are requiring 4 block
@@ -250,170 +281,577 @@ def ns_blocked(o, x, fellow_start, fellow_end):
 
     for f in range(fellow_start, fellow_end):
         # Consecutivity
-        for w in range(0, W, GRANULARITY):
-            # Either all or none of the block is SICU.
-            o.add(
-                Or(
-                    Sum([
-                        If(x[f, w_, shift], 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == GRANULARITY,
-                    Sum([
-                        If(x[f, w_, shift], 1, 0) for w_ in range(w, w + 3)
-                    ]) == 3,
-                    Sum([
-                        If(x[f, w_, shift], 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == 0,
-                )
-            )
+        for w in range(0, x.W, GRANULARITY):
+            # Either all, the first three, or none of the block is NS: the first
+            # three weeks move together and the last one only comes with them.
+            all_or_none(o, x.weeks(f, shift, w, w + 3))
+            implies(o, x[f, w + 3, shift], x[f, w, shift])
 
 
+@rule
 def ncc_blocked(o, x, fellow_start, fellow_end):
     # TODO: for now we are requiring 2 block
     GRANULARITY = 2
     for f in range(fellow_start, fellow_end):
         # Consecutivity
-        for w in range(0, W, GRANULARITY):
-            o.add(
-                Or(
-                    Sum([
-                        If(Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"], x[f, w_, "Swing"]), 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == GRANULARITY,
-                    Sum([
-                        If(Or(x[f, w_, "NCC1"], x[f, w_, "NCC2"], x[f, w_, "Swing"]), 1, 0) for w_ in range(w, w + GRANULARITY)
-                    ]) == 0,
-                )
-            )
+        for w in range(0, x.W, GRANULARITY):
+            all_or_none(o, x.weeks(f, NCC_ISH, w, w + GRANULARITY))
+
+# the first this many of each fellow's requested weeks are vacation, the rest
+# electives (see vacation_requests)
+N_VAC = 3
 
+@rule
 def vacation_requests(o, x, fellows, fellow_week_pairs, n_vac):
     # prash wants weeks 1, 7, and 36
     # (figure out a way to express this TODO)
     for f_, w_ in fellow_week_pairs.items():
         f = fellows.index(f_)
-        for w in w_[:n_vac]:
-            o.add(
-                x[f, w, "Vac"]
-            )
-        for w in w_[n_vac:]:
-            o.add(
-                x[f, w, "Elec"]
-            )
-
+        require(o, [x[f, w, "Vac"] for w in w_[:n_vac]])
+        require(o, [x[f, w, "Elec"] for w in w_[n_vac:]])
+
+@rule
+def previous_schedule(o, x, R, previous, weeks):
+    # Fellows keep their rotations from a previous schedule in these weeks; previous
+    # maps fellow index -> the index in R of each week's rotation, or -1 for none
+    # (see previous_rotations). One constraint per fellow-week, so as a soft rule
+    # it counts the changed assignments.
+    for f, rotation in previous.items():
+        for w in weeks:
+            require(o, [x[f, w, r] if rotation[w] == i else o.neg(x[f, w, r]) for i, r in enumerate(R)])
+
+@rule
 def fourth_block_two_micu_fellows(o, x, fellow_start, fellow_end):
     # from the fellows between start and end, ensure MICU is double-staffed for every week from 12-15
-    for w in range(12,16):
-        o.add(
-            Sum([If(x[f, w, "MICU"], 1, 0) for f in range(fellow_start, fellow_end)]) == 2,
-        )
+    for y in years(x):
+        for w in range(y + 12, y + 16):
+            exactly(o, x.fellows(w, "MICU", fellow_start, fellow_end), 2)
 
+@rule
 def comparable_amounts_each_half_year(o, x, fellow_start, fellow_end):
     # I don't want any shift to be massively frontloaded or backloaded.
     # no one's year should end with 8 NCC, 2 Elec, 8 NCC, 2 Elec, 8 NCC
     for f in range(fellow_start, fellow_end):
-        o.add(
-            Abs(
-                # Diff(
-                    Sum([
-                        If(x[f, w, "MICU"], 1, 0) for w in range(0, W // 2)
-                    ]) -
-                    Sum([
-                        If(x[f, w, "MICU"], 1, 0) for w in range(W // 2, W)
-                    ])
-                # )
-            ) <= 4
-        )
-
-        o.add(
-            Abs(
-                # Diff(
-                    Sum([
-                        If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"], x[f, w, "Swing"]), 1, 0) for w in range(0, W // 2)
-                    ]) -
-                    Sum([
-                        If(Or(x[f, w, "NCC1"], x[f, w, "NCC2"], x[f, w, "Swing"]), 1, 0) for w in range(W // 2, W)
-                    ])
-                # )
-            ) <= 4
+        for r in ["MICU", NCC_ISH]:
+            for y in years(x):
+                # |first half - second half| <= 4
+                weighted_between(o,
+                    [(v, 1) for v in x.weeks(f, r, y, y + W // 2)] +
+                    [(v, -1) for v in x.weeks(f, r, y + W // 2, y + W)],
+                    -4, 4)
+
+def maximize_swing_coverage(o, x, N):
+    # Objective: cover as many weeks' swing as we can (the deficit is only a floor).
+    with o.rule("swing_coverage", soft=True, weight=1):
+        for w in range(x.W):
+            at_least(o, x.fellows(w, "Swing", 0, N), 1)
+
+def make_solver(mode, tactic=None):
+    # "feasibility": we only need some schedule, so use a plain incremental Solver,
+    # optionally built from a tactic (e.g. "qffd" runs the PB constraints on the
+    # SAT core). "optimize": only then pay for Optimize, which gets the objectives.
+    if mode == "feasibility":
+        if tactic is None:
+            return Solver()
+        return Tactic(tactic).solver()
+    elif mode == "optimize":
+        return Optimize()
+    raise ValueError(f"Unknown mode {mode!r}, expected 'feasibility' or 'optimize'")
+
+def make_backend(backend, mode, tactic=None):
+    # "z3" (default): the z3 solver above. "cp-sat": OR-Tools CP-SAT, which
+    # searches on every core; it always optimizes soft constraints, and ignores
+    # tactic. Needs ortools installed.
+    if mode not in ("feasibility", "optimize"):
+        raise ValueError(f"Unknown mode {mode!r}, expected 'feasibility' or 'optimize'")
+    if backend == "z3":
+        return Z3Backend(make_solver(mode, tactic))
+    elif backend == "cp-sat":
+        return CpSatBackend()
+    raise ValueError(f"Unknown backend {backend!r}, expected 'z3' or 'cp-sat'")
+
+# Every rule optimize_schedule knows about, with its default parameters. Pass
+# rules={name: False} to switch one off, or rules={name: {param: value}} to change
+# its parameters.
+DEFAULT_RULES = {
+    "range_fellows_assigned_fully": {},
+    "everyone_one_rotation_per_week": {},
+    "ncc_shifts_covered_swing_deficit": {"deficit": 8},
+    "maximum_consecutive_icu_shifts": {"MAX_CONSEC": 8},
+    "jr_first_month_micu": {},
+    "jr_ncc_before_19": {"last_week": 19},
+    "jr_fellows_n_ncc_before_swing": {"n": 4},
+    "fourth_block_two_micu_fellows": {},
+    "sicu_blocked": {},
+    "micu_blocked": {},
+    "anaesthesia_blocked": {},
+    "vasc_blocked": {},
+    "ns_blocked": {},
+    "ncc_blocked": {},
+    "ncc_stroke_oversight": {},
+    "comparable_amounts_each_half_year": {},
+    "ccm_total_service": {},
+    "stroke_total_service": {},
+    "ncc_jr_total_service": {},
+    "ncc_sr_total_service": {},
+}
+
+BLOCKED_RULES = ["sicu_blocked", "micu_blocked", "anaesthesia_blocked", "vasc_blocked", "ns_blocked", "ncc_blocked"]
+
+def resolve_rules(rules=None):
+    # {rule name: parameters} for the enabled rules, from DEFAULT_RULES and overrides.
+    rules = rules or {}
+    unknown = set(rules) - set(DEFAULT_RULES)
+    if unknown:
+        raise ValueError(f"Unknown rules: {sorted(unknown)}")
+    resolved = {}
+    for name, params in DEFAULT_RULES.items():
+        setting = rules.get(name, True)
+        if setting is False:
+            continue
+        resolved[name] = {**params, **(setting if isinstance(setting, dict) else {})}
+    return resolved
+
+# The rules that keep each cohort off the rotations outside fellow_rotations.
+# The NCC cohorts' quotas add up to the whole year, so with at most one rotation
+# a week a 0 quota is 0 weeks; the stroke and CCM fellows are only scheduled for
+# their NCC time while their service rules are on.
+RESTRICTING_RULES = {
+    "jr": ["ncc_jr_total_service", "everyone_one_rotation_per_week"],
+    "sr": ["ncc_sr_total_service", "everyone_one_rotation_per_week"],
+    "stroke": ["stroke_total_service"],
+    "CCM": ["ccm_total_service"],
+}
+
+def hard_rules(rules=None, soft_rules=None):
+    # The enabled rules that aren't soft: only these may decide cells up front.
+    return {name: params for name, params in resolve_rules(rules).items() if name not in (soft_rules or {})}
+
+def restricted_cohorts(rules=None, soft_rules=None):
+    # The cohorts whose rotations these rules restrict (see RESTRICTING_RULES),
+    # as hard rules: a soft one can be broken, so it restricts nothing.
+    hard = hard_rules(rules, soft_rules)
+    return tuple(cohort for cohort, names in RESTRICTING_RULES.items() if all(n in hard for n in names))
+
+class ScheduleModel:
+    # The compiled model for one set of fellows, rotations and solver settings.
+    # Each rule is asserted once per set of parameters, under its own guard literal;
+    # solve() picks the enabled rules by assumption, and adds the volatile rules
+    # (vacation requests) under push/pop. So a what-if edit or a flipped checkbox
+    # only pays for a re-check of the same model.
+    #
+    # The model covers weeks weeks (whole years). With window=(start, stop) only
+    # those weeks are scheduled: the earlier ones are fixed to history (a fellow x
+    # week matrix of indices into R, as from VariableStore.assignment), the rest
+    # of the window's year is a lookahead that only some rules see (see xw below),
+    # and later years are left out. The other rules see everything past the
+    # window as unknown, and only constrain the window as far as they can without
+    # it (see cardinality.py, and solve_rolling).
+    #
+    # Rotations a fellow is never on (see fellow_rotations) are False from the
+    # start, not variables, for the restricted cohorts (by default those of the
+    # default rules, see restricted_cohorts); the model can then only be asked
+    # with rules that restrict at least those (as hard rules: soft ones restrict
+    # nothing). With presolve_for=(fellow_week_pairs, rules) the cells that
+    # request's hard rules force (see presolve.py) are constants too; the model
+    # then only solves that request, and doesn't diagnose it if unsat: the cells
+    # are decided without the rules that decided them (see optimize_schedule).
+
+    def __init__(
+        self,
+        jr_fellows: List[str],
+        sr_fellows: List[str],
+        stroke_fellows: List[str],
+        CCM_fellows: List[str],
+        R: List[str],
+        mode: str = "feasibility",
+        tactic: Optional[str] = None,
+        soft_rules: Optional[Dict[str, int]] = None,
+        encoding: str = "weekly",
+        backend: str = "z3",
+        weeks: int = W,
+        window=None,
+        history=None,
+        presolve_for=None,
+        restricted=None,
+    ):
+        self.fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
+        self.R = R
+        self.encoding = encoding
+        self.lock = threading.Lock()
+        if weeks <= 0 or weeks % W:
+            raise ValueError(f"weeks must be a whole number of {W}-week years, not {weeks}")
+        start, stop = window or (0, weeks)
+        # the end of the window's year
+        lookahead = min(weeks, -(-stop // W) * W)
+
+        num_NCC_jr_fellows = len(jr_fellows)
+        num_NCC_sr_fellows = len(sr_fellows)
+        num_stroke_fellows = len(stroke_fellows)
+        num_CCM_fellows = len(CCM_fellows)
+        N = num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows + num_CCM_fellows  # Number of fellows (example)
+
+
+        self.o = o = ScheduleSolver(
+            make_backend(backend, mode, tactic), soft_rules,
+            optimize=mode == "optimize" or backend == "cp-sat",
         )
-    pass
-
-def optimize_schedule(
-    jr_fellows: List[str],
-    sr_fellows: List[str],
-    stroke_fellows: List[str],
-    CCM_fellows: List[str],
-    R: List[str],
-    fellow_week_pairs: Dict[str, List[int]],
-):
-    fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
-
-    num_NCC_jr_fellows = len(jr_fellows)
-    num_NCC_sr_fellows = len(sr_fellows)
-    num_stroke_fellows = len(stroke_fellows)
-    num_CCM_fellows = len(CCM_fellows)
-    N = num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows + num_CCM_fellows  # Number of fellows (example)
-
-
-    # A 3D boolean variable: x[f, w, r] is True if fellow f is assigned to rotation r in week w
-    x = {
-        (f, w, r): Bool(f"x_{f}_{w}_{r}") for f in range(N) for w in range(W) for r in R
-    }
-
-    # s = Solver()
-    o = Optimize()
 
-
-    # assign NCC fellows fully
-    range_fellows_assigned_fully(o, x, R, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-    everyone_one_rotation_per_week(o, x, R, fellow_start=0, fellow_end=N)
-    ncc_shifts_covered_swing_deficit(o, x, N,8)
-    maximum_consecutive_icu_shifts(o, x, fellow_start=0, fellow_end=N, MAX_CONSEC=8)
-    jr_first_month_micu(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows)
-    jr_ncc_before_19(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows)
-    jr_fellows_n_ncc_before_swing(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows, n=4)
-    fourth_block_two_micu_fellows(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-
-    sicu_blocked(o,x, fellow_start=0, fellow_end=num_NCC_jr_fellows)
-    micu_blocked(o,x, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-    anaesthesia_blocked(o,x, fellow_start=0, fellow_end=num_NCC_jr_fellows)
-    vasc_blocked(o,x, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-    ns_blocked(o,x, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-    ncc_blocked(o,x, fellow_start=0, fellow_end=N)
-    ncc_stroke_oversight(o,x, fellow_start = 0, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows)
-    vacation_requests(o,x, fellows, fellow_week_pairs, n_vac=3)
-    comparable_amounts_each_half_year(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows)
-
-
-    """
-    sum over each fellow.
-    """
-    ccm_total_service(o,x, fellow_start=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows, fellow_end=N)
-    stroke_total_service(o,x,fellow_start=num_NCC_jr_fellows + num_NCC_sr_fellows, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows)
-    ncc_jr_total_service(o,x, fellow_start=0, fellow_end=num_NCC_jr_fellows)
-    ncc_sr_total_service(o,x, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows)
-
-    print(o.check())
-
-    m = o.model()
+        self.restricted = restricted_cohorts(None, soft_rules) if restricted is None else tuple(restricted)
+        rotations = [
+            fellow_rotations(R, quotas) if cohort in self.restricted else R
+            for cohort, quotas, n in [("jr", JR_QUOTAS, num_NCC_jr_fellows), ("sr", SR_QUOTAS, num_NCC_sr_fellows),
+                                      ("stroke", None, num_stroke_fellows), ("CCM", None, num_CCM_fellows)]
+            for f in range(n)
+        ]
+        forced, one_per_week = [], ()
+        self.presolved_for = None
+        if presolve_for is not None:
+            fellow_week_pairs, rules = presolve_for
+            self.presolved_for = (fellow_week_pairs, resolve_rules(rules))
+            # only hard rules decide cells: a soft one may be broken at a cost
+            hard = hard_rules(rules, soft_rules)
+            if "jr_first_month_micu" in hard:
+                forced += [(f, y + w, "MICU") for f in range(num_NCC_jr_fellows) for y in range(0, weeks, W) for w in range(4)]
+            if "vacation_requests" not in (soft_rules or {}):
+                for f_, w_ in fellow_week_pairs.items():
+                    f = self.fellows.index(f_)
+                    forced += [(f, w, "Vac") for w in w_[:N_VAC]] + [(f, w, "Elec") for w in w_[N_VAC:]]
+            if "everyone_one_rotation_per_week" in hard:
+                one_per_week = range(N)
+        fixed = presolve(R, weeks, rotations, forced, one_per_week)
+
+        # A 3D boolean variable: x[f, w, r] is True if fellow f is assigned to rotation r in week w
+        self.x = x = VariableStore(N, weeks, R, o.new_bool, DERIVED, free=range(start, lookahead), fixed=fixed)
+        for f in range(N):
+            for w in range(start):
+                for i, r in enumerate(R):
+                    x[f, w, r] = bool(history[f, w] == i)
+
+        # encoding="block" builds the blocking into the variables; the *_blocked
+        # rules then hold trivially and can't be switched off (see request).
+        if encoding == "block":
+            block_variables(x, [
+                # rotation, fellows, weeks per block, weeks sharing a variable (as in the *_blocked rules)
+                ("SICU", range(0, num_NCC_jr_fellows), 4, 4),
+                ("MICU", range(0, num_NCC_jr_fellows+num_NCC_sr_fellows), 2, 2),
+                ("Anaesthesia", range(0, num_NCC_jr_fellows), 4, 4),
+                ("Vasc/Clin", range(num_NCC_jr_fellows, num_NCC_jr_fellows+num_NCC_sr_fellows), 4, 4),
+                ("NS", range(num_NCC_jr_fellows, num_NCC_jr_fellows+num_NCC_sr_fellows), 4, 3),
+            ])
+            derived_rotations(o, x, N, ncc_block=2)
+        elif encoding == "weekly":
+            derived_rotations(o, x, N)
+        else:
+            raise ValueError(f"Unknown encoding {encoding!r}, expected 'weekly' or 'block'")
+        # How much of the model is decided up front: of the cells of the real
+        # rotations in the weeks searched, how many are constants.
+        real = set(R)
+        cells = N * len(R) * (lookahead - start)
+        self.size = {"cells": cells, "fixed": cells - sum(1 for (f, w, r), _ in x.items() if r in real)}
+
+        # What the rules about the order of rotations see. The lookahead is left to
+        # the rules counting them (per week or (half) year) and to the cap on
+        # consecutive ICU weeks, which limits how densely they can be packed:
+        # enough to keep the yearly totals within reach, without searching it.
+        xw = x.without(range(stop, lookahead)) if lookahead > stop else x
+
+        # How to apply each rule to this program's fellows, given its parameters.
+        self.rule_calls = {
+            # assign NCC fellows fully
+            "range_fellows_assigned_fully": lambda: range_fellows_assigned_fully(o, x, R, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+            "everyone_one_rotation_per_week": lambda: everyone_one_rotation_per_week(o, x, R, fellow_start=0, fellow_end=N),
+            "ncc_shifts_covered_swing_deficit": lambda deficit: ncc_shifts_covered_swing_deficit(o, x, N, deficit),
+            "maximum_consecutive_icu_shifts": lambda MAX_CONSEC: maximum_consecutive_icu_shifts(o, x, fellow_start=0, fellow_end=N, MAX_CONSEC=MAX_CONSEC),
+            "jr_first_month_micu": lambda: jr_first_month_micu(o, xw, fellow_start=0, fellow_end=num_NCC_jr_fellows),
+            "jr_ncc_before_19": lambda last_week: jr_ncc_before_19(o, xw, fellow_start=0, fellow_end=num_NCC_jr_fellows, last_week=last_week),
+            "jr_fellows_n_ncc_before_swing": lambda n: jr_fellows_n_ncc_before_swing(o, xw, fellow_start=0, fellow_end=num_NCC_jr_fellows, n=n),
+            "fourth_block_two_micu_fellows": lambda: fourth_block_two_micu_fellows(o, xw, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+
+            "sicu_blocked": lambda: sicu_blocked(o,xw, fellow_start=0, fellow_end=num_NCC_jr_fellows),
+            "micu_blocked": lambda: micu_blocked(o,xw, fellow_start=0, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+            "anaesthesia_blocked": lambda: anaesthesia_blocked(o,xw, fellow_start=0, fellow_end=num_NCC_jr_fellows),
+            "vasc_blocked": lambda: vasc_blocked(o,xw, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+            "ns_blocked": lambda: ns_blocked(o,xw, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+            "ncc_blocked": lambda: ncc_blocked(o,xw, fellow_start=0, fellow_end=N),
+            "ncc_stroke_oversight": lambda: ncc_stroke_oversight(o,x, fellow_start = 0, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows),
+            "comparable_amounts_each_half_year": lambda: comparable_amounts_each_half_year(o, x, fellow_start=0, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows),
+
+            # sum over each fellow.
+            "ccm_total_service": lambda: ccm_total_service(o,x, fellow_start=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows, fellow_end=N),
+            "stroke_total_service": lambda: stroke_total_service(o,x,fellow_start=num_NCC_jr_fellows + num_NCC_sr_fellows, fellow_end=num_NCC_jr_fellows + num_NCC_sr_fellows + num_stroke_fellows),
+            "ncc_jr_total_service": lambda: ncc_jr_total_service(o,x, fellow_start=0, fellow_end=num_NCC_jr_fellows),
+            "ncc_sr_total_service": lambda: ncc_sr_total_service(o,x, fellow_start=num_NCC_jr_fellows, fellow_end=num_NCC_jr_fellows+num_NCC_sr_fellows),
+        }
+        # (rule name, parameters) -> guard literal, for every rule asserted so far,
+        # and back from the guard's key. The vacation requests are re-asserted for
+        # each solve, but always under the same guard.
+        self.guards = {}
+        self.vacation_guard = o.new_bool("rule_vacation_requests")
+        self.guard_keys = {o.key(self.vacation_guard): ("vacation_requests", ())}
+        # variable key -> (fellow, week), to label constraints when diagnosing
+        self.cells = None
+        # fellow classes -> guard of their symmetry-breaking constraints
+        self.symmetry_guards = {}
+        for name, params in resolve_rules().items():
+            self.guard(name, params)
+
+        if mode == "optimize":
+            maximize_swing_coverage(o, x, N)
+
+    def guard(self, name, params):
+        # The guard literal for this rule with these parameters, asserting the rule
+        # under it the first time it is asked for.
+        key = (name, tuple(sorted(params.items())))
+        if key not in self.guards:
+            label = "_".join([name] + [f"{k}={v}" for k, v in key[1]])
+            g = self.o.new_bool(f"rule_{label}")
+            with self.o.guarded(g):
+                self.rule_calls[name](**params)
+            self.guards[key] = g
+            self.guard_keys[self.o.key(g)] = key
+        return self.guards[key]
+
+    def enabled(self, rules=None):
+        # The enabled rules' guards.
+        return [self.guard(name, params) for name, params in resolve_rules(rules).items()]
+
+    def assumptions(self, enabled):
+        # The enabled guards, and the negation of every other guard.
+        on = {self.o.key(g) for g in enabled}
+        return [g if self.o.key(g) in on else self.o.neg(g) for g in self.guards.values()]
+
+    def symmetry_guard(self, fellow_week_pairs):
+        # Guard of the symmetry-breaking constraints for the fellows that are
+        # interchangeable given these requests (see symmetry.py).
+        classes = fellow_classes(self.o.applications, len(self.fellows), fellow_week_pairs, self.fellows)
+        key = tuple(tuple(members) for members in classes)
+        if key not in self.symmetry_guards:
+            g = self.o.new_bool(f"symmetry_{len(self.symmetry_guards)}")
+            with self.o.guarded(g):
+                break_symmetries(self.o, self.x, self.R, classes, self.x.W, order_by=[NCC_ISH])
+            self.symmetry_guards[key] = g
+        return self.symmetry_guards[key]
+
+    def solve(self, fellow_week_pairs: Dict[str, List[int]], rules=None, symmetry_breaking=False,
+              timeout=None, max_conflicts=None, progress=None, previous=None, from_week=0, change_weight=1,
+              hint=None, free=None):
+        rotation, report = self.solve_rotation(fellow_week_pairs, rules, symmetry_breaking, timeout, max_conflicts,
+                                               progress, previous, from_week, change_weight, hint, free)
+        if rotation is None:
+            return None, None, report
+        shifts_for_fellows, fellows_for_shifts = extract_schedule(rotation, self.fellows, self.R)
+        return shifts_for_fellows, fellows_for_shifts, report
+
+    def solve_rotation(self, fellow_week_pairs: Dict[str, List[int]], rules=None, symmetry_breaking=False,
+                       timeout=None, max_conflicts=None, progress=None, previous=None, from_week=0, change_weight=1,
+                       hint=None, free=None, diagnose=True):
+        # solve(), with the schedule as a rotation matrix (see VariableStore.assignment).
+        # previous (see previous_rotations) repairs that schedule: weeks before
+        # from_week are kept as they were, and each later fellow-week that changes
+        # costs change_weight. hint (in the same form) is a schedule for the search
+        # to start from, where the backend can; previous by default.
+        # free = (fellow indices, weeks) re-solves just that neighbourhood of
+        # previous instead: every other fellow-week is kept as it was, and the
+        # ones inside it change freely (see lns.py). diagnose=False skips naming
+        # the conflicting rules when unsat.
+        o = self.o
+        # one solve at a time per model: Streamlit sessions share it
+        with self.lock, o.budget(timeout, max_conflicts, progress):
+            enabled, assumptions = self.request(fellow_week_pairs, rules, symmetry_breaking, previous, from_week, change_weight,
+                                                previous if hint is None else hint, free)
+            try:
+                # a neighbourhood unsat given the rest of the schedule isn't worth diagnosing
+                rotation, report = self.outcome(o.check(*assumptions), enabled, fellow_week_pairs,
+                                                diagnose=diagnose and free is None)
+            finally:
+                o.pop()
+
+        if rotation is not None and previous is not None:
+            report["changes"] = [
+                (self.fellows[f], w, self.R[before[w]] if before[w] >= 0 else "", self.R[rotation[f, w]] if rotation[f, w] >= 0 else "")
+                for f, before in previous.items() for w in range(from_week, self.x.W) if rotation[f, w] != before[w]
+            ]
+        return rotation, report
+
+    def alternatives(self, fellow_week_pairs: Dict[str, List[int]], rules=None, symmetry_breaking=False,
+                     timeout=None, max_conflicts=None, progress=None, n=3, min_distance=8, over=(NCC_ISH,)):
+        # Up to n schedules for the same request, each yielded as soon as it is found
+        # (as solve() returns it), and each differing from every earlier one in at
+        # least min_distance of the fellow-week assignments to the rotations in over
+        # (by default: who is on NCC-ish duty when). After each schedule a constraint
+        # excluding everything within that distance of it is added to the same
+        # solver scope, so later checks keep what the solver has learnt so far. Stops
+        # early once there are no more such schedules, or on running out of the
+        # budget (timeout covers all n); if there isn't even a first one, its
+        # (None, None, report) is yielded as from solve(). The model is locked
+        # until the generator is exhausted or closed: stopping early on a shared
+        # model, use contextlib.closing(model.alternatives(...)).
+        o, x = self.o, self.x
+        # the distinct literals compared: weeks of a block may share one
+        keys, lits = set(), []
+        for f in range(len(self.fellows)):
+            for r in over:
+                for l in x.weeks(f, r):
+                    if is_literal(l) and o.key(l) not in keys:
+                        keys.add(o.key(l))
+                        lits.append(l)
+
+        with self.lock, o.budget(timeout, max_conflicts, progress):
+            enabled, assumptions = self.request(fellow_week_pairs, rules, symmetry_breaking)
+            try:
+                for i in range(n):
+                    # only the first check is diagnosed: later ones are unsat because
+                    # of the earlier schedules, not the rules
+                    rotation, report = self.outcome(o.check(*assumptions), enabled, fellow_week_pairs, diagnose=i == 0)
+                    if rotation is None:
+                        if i == 0:
+                            yield None, None, report
+                        return
+                    # at least min_distance of lits must differ from their values now
+                    at_least(o, [o.neg(l) if v else l for l, v in zip(lits, o.values(lits))], min_distance)
+                    report["index"] = i
+                    yield (*extract_schedule(rotation, self.fellows, self.R), report)
+            finally:
+                o.pop()
+
+    def request(self, fellow_week_pairs, rules, symmetry_breaking, previous=None, from_week=0, change_weight=1,
+                hint=None, free=None):
+        # Open a solver scope (the caller pops it) with this request's vacation
+        # requests, previous schedule and hint, and return the enabled guards and
+        # the assumptions to check.
+        o, x = self.o, self.x
+        if self.presolved_for is not None and self.presolved_for != (fellow_week_pairs, resolve_rules(rules)):
+            raise ValueError("This model was presolved for another request")
+        if not set(self.restricted) <= set(restricted_cohorts(rules, o.soft_rules)):
+            raise ValueError("This model keeps cohorts off rotations these rules allow; build it with "
+                             "restricted=restricted_cohorts(rules, soft_rules)")
+        if self.encoding == "block" and not set(BLOCKED_RULES) <= set(hard_rules(rules, o.soft_rules)):
+            raise ValueError(f"encoding='block' always blocks the rotations: it needs every one of {BLOCKED_RULES} "
+                             "on, and hard; use encoding='weekly'")
+        if previous is not None and symmetry_breaking:
+            raise ValueError("symmetry_breaking can't be used when repairing: the history tells fellows apart")
+        enabled = self.enabled(rules) + [self.vacation_guard]
+        assumptions = self.assumptions(enabled) + [self.vacation_guard]
+        if symmetry_breaking:
+            assumptions.append(self.symmetry_guard(fellow_week_pairs))
+        o.push()
+        try:
+            with o.guarded(self.vacation_guard):
+                vacation_requests(o, x, self.fellows, fellow_week_pairs, n_vac=N_VAC)
+            if previous is not None and free is not None:
+                # Everything outside the neighbourhood is fixed, as the past is below.
+                fellows, weeks = set(free[0]), set(free[1])
+                outside = [w for w in range(x.W) if w not in weeks]
+                previous_schedule(o, x, self.R, {f: r for f, r in previous.items() if f not in fellows}, range(x.W), soft=False)
+                previous_schedule(o, x, self.R, {f: r for f, r in previous.items() if f in fellows}, outside, soft=False)
+            elif previous is not None:
+                # The past is fixed: asserted outright rather than under a guard, so
+                # the solver simplifies those weeks away before searching (and a
+                # diagnosis takes them as given). Each change to the future costs.
+                previous_schedule(o, x, self.R, previous, range(from_week), soft=False)
+                previous_schedule(o, x, self.R, previous, range(from_week, x.W), soft=True, weight=change_weight)
+            if hint is not None:
+                # the search starts from this schedule, where the backend can
+                cells = [(f, w, i) for f in hint for w in range(x.W) for i, r in enumerate(self.R) if is_literal(x[f, w, r])]
+                o.hint([x[f, w, self.R[i]] for f, w, i in cells], [hint[f][w] == i for f, w, i in cells])
+        except BaseException:
+            o.pop()
+            raise
+        return enabled, assumptions
+
+    def outcome(self, result, enabled, fellow_week_pairs, diagnose=True):
+        # The schedule (as a rotation matrix, or None) and report for the result of a
+        # check, which progress also hears of.
+        o = self.o
+        report = {
+            "status": result, "statistics": o.statistics(), "presolve": self.size,
+            # what each rule put into the model (see ScheduleSolver.profile)
+            "profile": {name: dict(entry) for name, entry in o.profile.items()},
+        }
+        rotation = None
+        if result == "sat":
+            report["violations"] = o.violation_costs()
+            if o.optimize:
+                # False if the budget ran out first: the best schedule found until then
+                report["optimal"] = o.optimal
+            rotation = self.x.assignment(o.values)
+        elif result == "unsat" and diagnose and self.presolved_for is None:
+            report["conflicts"] = self.diagnose(enabled, fellow_week_pairs)
+        report["elapsed"] = o.elapsed()
+        o.report(**report)
+        return rotation, report
+
+    def diagnose(self, enabled, fellow_week_pairs, timeout=5000):
+        # Why are these rules unsat? A minimal list of conflicting rules, narrowed to
+        # fellows or week-blocks where possible, e.g. ["jr_first_month_micu(NCC Raya)",
+        # "vacation_requests(NCC Raya)", ...]. timeout (ms) bounds each check.
+        o = self.o
+
+        # First which rules: a minimal set of the enabled guards.
+        core = o.minimal_core(enabled, timeout)
+        if not core:
+            return []
+        rule_names = [self.guard_keys[o.key(g)][0] for g in core]
+
+        # Then which fellows and weeks: re-assert only those rules, tracking each
+        # fellow's / week-block's constraints separately, and minimize over those.
+        o.push()
+        try:
+            with o.tracked(self.label):
+                for g in core:
+                    name, params = self.guard_keys[o.key(g)]
+                    if name == "vacation_requests":
+                        vacation_requests(o, self.x, self.fellows, fellow_week_pairs, n_vac=N_VAC)
+                    else:
+                        self.rule_calls[name](**dict(params))
+            labels = {o.key(lit): label for label, lit in o.tracking.items()}
+            fine = o.minimal_core(list(o.tracking.values()), timeout)
+        finally:
+            o.pop()
+            o.tracking = {}
+        if not fine:
+            return rule_names
+        return [labels[o.key(lit)] for lit in fine]
+
+    def label(self, rule_name, lits):
+        # "rule(fellow)" for a constraint about one fellow, "rule(weeks 12-15)" for
+        # one about a single 4-week block, otherwise just "rule".
+        if self.cells is None:
+            self.cells = {self.o.key(v): (f, w) for (f, w, r), v in self.x.items()}
+        fellows, blocks = set(), set()
+        for l in lits:
+            if self.o.key(l) in self.cells:
+                f, w = self.cells[self.o.key(l)]
+                fellows.add(f)
+                blocks.add(w // 4)
+        if len(fellows) == 1:
+            return f"{rule_name}({self.fellows[fellows.pop()]})"
+        if len(blocks) == 1:
+            b = blocks.pop()
+            return f"{rule_name}(weeks {4 * b}-{4 * b + 3})"
+        return rule_name
+
+
+def extract_schedule(rotation, fellows, R):
+    # rotation is the schedule as a fellow x week matrix of indices into R (see
+    # VariableStore.assignment).
 
     shifts_for_fellows = {
-        fellow: ["" for w in range(W)] for fellow in fellows
+        fellow: [R[i] if i >= 0 else "" for i in rotation[f]] for f, fellow in enumerate(fellows)
     }
 
+    weeks = rotation.shape[1]
     fellows_for_shifts = {
-        'NCC1': [[] for w in range(W)],
-        'NCC2': [[] for w in range(W)],
-        'Extra': [[] for w in range(W)],
-        'Swing': [[] for w in range(W)],
+        'NCC1': [[] for w in range(weeks)],
+        'NCC2': [[] for w in range(weeks)],
+        'Extra': [[] for w in range(weeks)],
+        'Swing': [[] for w in range(weeks)],
     }
-
-    for d in m.decls():
-        if m[d]:
-            _, f, w, s = d.name().split('_')
-            shifts_for_fellows[fellows[int(f)]][int(w)] = s
-            if s in fellows_for_shifts:
-                fellows_for_shifts[s][int(w)].append(fellows[int(f)])
-
-            # print ("%s = %s" % (d.name(), m[d]))
+    for s in ['NCC1', 'NCC2', 'Swing']:
+        if s in R:
+            for f, w in zip(*(rotation == R.index(s)).nonzero()):
+                fellows_for_shifts[s][w].append(fellows[f])
 
     # figure out who's extra and who isn't
     for s, v in fellows_for_shifts.items():
@@ -428,18 +866,441 @@ def optimize_schedule(
                 fellows_for_shifts[s][ii] = its[0]
                 # fellows_for_shifts['Extra'][ii] = ""
                 continue
-            elif type(its) is list and len(its) == 2:
+            elif type(its) is list:
                 # print(len(its), its)
                 # extra hierarchy: CCM is more extra than stroke is more extra than NCC natives.
-                fellows_for_shifts['Extra'][ii] = max(its)
-                fellows_for_shifts[s][ii] = min(its)
-            else:
-                # print(s, ii, its)
-                continue
+                # Everyone after the first is extra (joined, if more than one).
+                its = sorted(its)
+                extra = fellows_for_shifts['Extra'][ii]
+                fellows_for_shifts['Extra'][ii] = ", ".join(([extra] if extra else []) + its[1:])
+                fellows_for_shifts[s][ii] = its[0]
     # print(fellows_for_shifts['Extra'])
 
     return shifts_for_fellows, fellows_for_shifts
 
+
+def previous_rotations(shifts_for_fellows, fellows, R):
+    # The inverse of extract_schedule for repairs: {fellow index: [index in R of
+    # each week's rotation, or -1 for none]}, for the fellows shifts_for_fellows has.
+    previous = {}
+    for fellow, shifts in shifts_for_fellows.items():
+        if fellow not in fellows:
+            raise ValueError(f"Unknown fellow {fellow!r} in the previous schedule")
+        if len(shifts) != W:
+            raise ValueError(f"{fellow!r} has {len(shifts)} weeks in the previous schedule, expected {W}")
+        unknown = set(shifts) - set(R) - {"", None}
+        if unknown:
+            raise ValueError(f"Unknown rotations {sorted(unknown)} for {fellow!r} in the previous schedule")
+        previous[fellows.index(fellow)] = [R.index(s) if s else -1 for s in shifts]
+    return previous
+
+def read_schedule(filename):
+    # shifts_for_fellows back from a workbook written by this script (file name or
+    # file object): its "Per-Fellow Schedule" sheet has a column per fellow (only
+    # the NCC fellows).
+    ws = openpyxl.load_workbook(filename, read_only=True)["Per-Fellow Schedule"]
+    rows = ws.iter_rows(min_row=1, max_row=W + 1, values_only=True)
+    header = next(rows)
+    columns = [(i, fellow) for i, fellow in enumerate(header) if i > 0 and fellow]
+    shifts_for_fellows = {fellow: [] for _, fellow in columns}
+    for row in rows:
+        for i, fellow in columns:
+            shifts_for_fellows[fellow].append(row[i] or "")
+    return shifts_for_fellows
+
+def read_shift_schedule(filename):
+    # fellows_for_shifts back from the same workbook's "NCC Shift Schedule" sheet:
+    # who was on NCC1, NCC2, Extra and Swing each week, stroke and CCM fellows
+    # included.
+    ws = openpyxl.load_workbook(filename, read_only=True)["NCC Shift Schedule"]
+    rows = ws.iter_rows(min_row=1, max_row=W + 1, values_only=True)
+    header = next(rows)
+    columns = [(i, shift) for i, shift in enumerate(header) if i > 0 and shift]
+    fellows_for_shifts = {shift: [] for _, shift in columns}
+    for row in rows:
+        for i, shift in columns:
+            fellows_for_shifts[shift].append(row[i] or "")
+    return fellows_for_shifts
+
+
+# Compiled models kept between calls, keyed by everything the static part depends on.
+MAX_CACHED_MODELS = 4
+_models = OrderedDict()
+_models_lock = threading.Lock()
+
+def schedule_model(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode="feasibility", tactic=None, soft_rules=None, encoding="weekly", backend="z3", weeks=W, restricted=None):
+    # restricted as for ScheduleModel: pass restricted_cohorts(rules, soft_rules) for the rules it will be asked with
+    restricted = restricted_cohorts(None, soft_rules) if restricted is None else tuple(restricted)
+    key = (
+        tuple(jr_fellows), tuple(sr_fellows), tuple(stroke_fellows), tuple(CCM_fellows), tuple(R),
+        mode, tactic, tuple(sorted((soft_rules or {}).items())), encoding, backend, weeks, restricted,
+    )
+    with _models_lock:
+        if key in _models:
+            _models.move_to_end(key)
+        else:
+            _models[key] = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend, weeks,
+                                         restricted=restricted)
+            while len(_models) > MAX_CACHED_MODELS:
+                _models.popitem(last=False)
+        return _models[key]
+
+def optimize_schedule(
+    jr_fellows: List[str],
+    sr_fellows: List[str],
+    stroke_fellows: List[str],
+    CCM_fellows: List[str],
+    R: List[str],
+    fellow_week_pairs: Dict[str, List[int]],
+    mode: str = "feasibility",
+    tactic: Optional[str] = None,
+    soft_rules: Optional[Dict[str, int]] = None,
+    incremental: bool = True,
+    rules: Optional[Dict] = None,
+    symmetry_breaking: bool = False,
+    encoding: str = "weekly",
+    portfolio: bool = False,
+    backend: str = "z3",
+    timeout: Optional[float] = None,
+    max_conflicts: Optional[int] = None,
+    progress=None,
+    weeks: int = W,
+    window: Optional[int] = None,
+    presolve: bool = False,
+    cache=None,
+):
+    """
+    soft_rules maps rule names (e.g. "ncc_stroke_oversight") to the weight of
+    violating one of their constraints; those rules become soft and everything
+    else stays hard. In "optimize" mode the total weight is minimized.
+
+    rules switches rules off ({name: False}) or changes their parameters
+    ({name: {param: value}}); see DEFAULT_RULES.
+
+    symmetry_breaking orders the NCC weeks of interchangeable fellows (same
+    rules, same requests) and NCC1/NCC2 within each week, so the solver
+    doesn't search equivalent schedules. Off by default: on the example
+    program it doesn't pay for itself, but it can on larger cohorts.
+
+    encoding="block" uses one variable per fellow-block for the blocked
+    rotations (MICU, SICU, Anaesthesia, Vasc/Clin, NS) and NCC-ish, rather
+    than per week; the blocking rules are then always on, and hard: rules
+    turning one off, or soft_rules making one soft, raise ValueError.
+
+    backend="cp-sat" solves with OR-Tools CP-SAT instead of z3 (if installed);
+    it optimizes the soft rules in either mode.
+
+    timeout (seconds, wall clock) bounds solving, diagnosis included (not
+    building the model), and max_conflicts each solver check; out of budget,
+    the status is
+    "unknown". In "optimize" mode the best schedule found by then is still
+    returned, with report["optimal"] False. progress(info) is called with
+    info["elapsed"] (seconds) and info["objective"] (violation cost) at each
+    improving schedule while optimizing, and with the final report (including
+    solver statistics) at the end.
+
+    portfolio=True races several seeds and settings (encoding, symmetry
+    breaking, tactic) in parallel processes and returns the first answer;
+    see portfolio.py. progress then hears every process, with info["config"]
+    naming the settings each report comes from.
+
+    weeks is the horizon: a whole number of years, each with the same
+    yearly rules (totals, first month, half-year balance, ...), e.g.
+    2 * W for two academic years. With window (weeks, a multiple of 4)
+    the horizon is solved a window at a time instead of all at once; see
+    solve_rolling. Off by default: it only pays on programs too big to
+    solve whole.
+
+    With incremental=True the compiled model for these fellows, rotations and
+    settings is reused from earlier calls: rules are picked by assumption and
+    only the vacation requests are re-asserted. incremental=False always builds
+    from scratch.
+
+    presolve=True builds a model for just this request instead, with the
+    cells its hard rules decide on their own (first-month MICU, vacation
+    requests, and so the rest of those weeks; a rule in soft_rules decides
+    nothing, as it may be broken) fixed up front rather than
+    left to the solver; see presolve.py. report["presolve"] says how many
+    of the model's cells are fixed. If there is no schedule, the request is
+    solved again without presolving, to diagnose it.
+
+    cache (a ScheduleCache, see schedule_cache.py) answers a request it has
+    seen before from disk, in milliseconds, with report["cached"] True: the
+    same fellows, rotations, vacation requests, rules and their parameters,
+    mode, soft rules, weeks, encoding, window and presolve (the other
+    settings only change how the answer is found; a rolling or presolved
+    solve reports differently, so it isn't mixed with a plain one). Only final answers are stored: a schedule
+    (an optimal one in "optimize" mode) or unsat, not a timeout.
+
+    Returns shifts_for_fellows, fellows_for_shifts and a report with the solver
+    status and the violation cost per soft rule. report["profile"] says what
+    each rule put into the model (seconds spent building it, constraints,
+    literals in them, fresh variables), and report["statistics"] holds the
+    solver's own counters (conflicts, decisions, memory, ...), to tell which
+    rules make a slow solve slow. If there is no schedule, the
+    first two are None and report["conflicts"] names a minimal set of
+    conflicting rules (per fellow / week-block where possible).
+    """
+    if cache is not None:
+        key = cache.key(
+            RULES_VERSION, jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+            resolve_rules(rules), mode, soft_rules or {}, weeks, encoding, window, presolve,
+        )
+        cached = cache.get(key)
+        if cached is not None:
+            shifts_for_fellows, fellows_for_shifts, report = cached
+            report["cached"] = True
+            return shifts_for_fellows, fellows_for_shifts, report
+        result = optimize_schedule(
+            jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+            mode=mode, tactic=tactic, soft_rules=soft_rules, incremental=incremental, rules=rules,
+            symmetry_breaking=symmetry_breaking, encoding=encoding, portfolio=portfolio, backend=backend,
+            timeout=timeout, max_conflicts=max_conflicts, progress=progress, weeks=weeks, window=window,
+            presolve=presolve,
+        )
+        report = result[2]
+        if report["status"] == "unsat" or (report["status"] == "sat" and report.get("optimal", True)):
+            cache.put(key, result)
+        return result
+    if portfolio:
+        from portfolio import solve_portfolio
+        return solve_portfolio(
+            jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+            mode=mode, tactic=tactic, soft_rules=soft_rules, incremental=incremental,
+            rules=rules, symmetry_breaking=symmetry_breaking, encoding=encoding, backend=backend,
+            timeout=timeout, max_conflicts=max_conflicts, progress=progress, weeks=weeks, window=window,
+            presolve=presolve,
+        )
+    if window is not None:
+        return solve_rolling(
+            jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+            weeks=weeks, window=window, mode=mode, tactic=tactic, soft_rules=soft_rules, rules=rules,
+            encoding=encoding, backend=backend, timeout=timeout, max_conflicts=max_conflicts, progress=progress,
+        )
+    if presolve:
+        model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend, weeks,
+                              presolve_for=(fellow_week_pairs, rules), restricted=restricted_cohorts(rules, soft_rules))
+        result = model.solve(fellow_week_pairs, rules, symmetry_breaking, timeout, max_conflicts, progress)
+        if result[2]["status"] != "unsat":
+            return result
+        if timeout is not None:
+            timeout = max(0, timeout - result[2]["elapsed"])
+        model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend, weeks,
+                              restricted=restricted_cohorts(rules, soft_rules))
+    elif incremental:
+        model = schedule_model(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend, weeks,
+                               restricted_cohorts(rules, soft_rules))
+    else:
+        model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend, weeks,
+                              restricted=restricted_cohorts(rules, soft_rules))
+    return model.solve(fellow_week_pairs, rules, symmetry_breaking, timeout, max_conflicts, progress)
+
+def alternative_schedules(
+    jr_fellows: List[str],
+    sr_fellows: List[str],
+    stroke_fellows: List[str],
+    CCM_fellows: List[str],
+    R: List[str],
+    fellow_week_pairs: Dict[str, List[int]],
+    n: int = 3,
+    min_distance: int = 8,
+    mode: str = "feasibility",
+    tactic: Optional[str] = None,
+    soft_rules: Optional[Dict[str, int]] = None,
+    rules: Optional[Dict] = None,
+    symmetry_breaking: bool = False,
+    encoding: str = "weekly",
+    backend: str = "z3",
+    timeout: Optional[float] = None,
+    max_conflicts: Optional[int] = None,
+    progress=None,
+):
+    """
+    Generate up to n different schedules for the same request, as
+    optimize_schedule returns them (report["index"] counts them), each as
+    soon as the solver finds it. Each differs from all the earlier ones in
+    at least min_distance fellow-weeks of NCC-ish duty (NCC1, NCC2 or
+    Swing). They come from one solver session, so the second and later
+    schedules are usually much cheaper than the first. Fewer than n come
+    out if there are no more that different, or timeout (seconds, for all
+    of them) runs out. The other arguments are as for optimize_schedule.
+
+    The session is on a model of its own, not the cached one the other
+    calls share: it stays open from the first schedule to the last, and a
+    caller that stops iterating early must not leave a shared model
+    locked.
+    """
+    model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend,
+                          restricted=restricted_cohorts(rules, soft_rules))
+    yield from model.alternatives(fellow_week_pairs, rules, symmetry_breaking, timeout, max_conflicts, progress, n, min_distance)
+
+def repair_schedule(
+    jr_fellows: List[str],
+    sr_fellows: List[str],
+    stroke_fellows: List[str],
+    CCM_fellows: List[str],
+    R: List[str],
+    fellow_week_pairs: Dict[str, List[int]],
+    previous,
+    from_week: int,
+    change_weight: int = 10,
+    mode: str = "optimize",
+    tactic: Optional[str] = None,
+    soft_rules: Optional[Dict[str, int]] = None,
+    rules: Optional[Dict] = None,
+    encoding: str = "weekly",
+    backend: str = "z3",
+    timeout: Optional[float] = None,
+    max_conflicts: Optional[int] = None,
+    progress=None,
+):
+    """
+    Repair an existing schedule mid-year, e.g. after a vacation request
+    changes: previous is its shifts_for_fellows, or the file name of a
+    workbook this script wrote. Weeks before from_week are kept exactly as
+    they were; every later fellow-week that changes costs change_weight,
+    charged to the soft rule "previous_schedule", and in "optimize" mode
+    the total cost is minimized. The default weight puts stability before
+    the other soft rules (an uncovered swing week costs 1). Fellows
+    missing from previous (the workbook only has the NCC fellows) are
+    scheduled afresh.
+
+    Returns what optimize_schedule does, with report["changes"] listing the
+    changed (fellow, week, old rotation, new rotation). The other arguments
+    are as for optimize_schedule.
+    """
+    if isinstance(previous, str):
+        previous = read_schedule(previous)
+    fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
+    model = schedule_model(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules, encoding, backend,
+                           restricted=restricted_cohorts(rules, soft_rules))
+    return model.solve(fellow_week_pairs, rules, False, timeout, max_conflicts, progress,
+                       previous=previous_rotations(previous, fellows, R), from_week=from_week,
+                       change_weight=change_weight)
+
+def solve_rolling(
+    jr_fellows: List[str],
+    sr_fellows: List[str],
+    stroke_fellows: List[str],
+    CCM_fellows: List[str],
+    R: List[str],
+    fellow_week_pairs: Dict[str, List[int]],
+    weeks: int = W,
+    window: int = 24,
+    step: Optional[int] = None,
+    polish: bool = False,
+    mode: str = "feasibility",
+    tactic: Optional[str] = None,
+    soft_rules: Optional[Dict[str, int]] = None,
+    rules: Optional[Dict] = None,
+    encoding: str = "weekly",
+    backend: str = "z3",
+    timeout: Optional[float] = None,
+    max_conflicts: Optional[int] = None,
+    progress=None,
+    window_timeout: Optional[float] = 10,
+):
+    """
+    Rolling-horizon solve, for horizons too long (or programs too big) to
+    solve in one go: solve weeks 0..window-1 with a model of just those
+    weeks, keep the first step of them (default: all but the last 4-week
+    block), solve the next window from there with the kept weeks fixed,
+    and so on. Both window and step are multiples of 4, so the blocks
+    line up. Every rule sees the fixed weeks as they are. The rules that
+    count rotations (yearly totals, weekly coverage, ...) and the cap on
+    consecutive ICU weeks also see the rest of the window's year,
+    unscheduled; the others (NCC before swing, blocks, ...) assume the
+    best of the weeks after the window. The last window checks every
+    rule over the whole horizon.
+
+    A window can still be a dead end: unsat, or not solved within
+    window_timeout seconds (solve times vary wildly once earlier weeks
+    are fixed). Then the previous step is reopened and the window
+    widened, up to the whole horizon, which gets the rest of the budget.
+    Only that whole-horizon solve can answer unsat (diagnosed as usual):
+    a window's unsat only says the earlier windows' choices were wrong,
+    so it isn't diagnosed, and running out of budget on one is
+    "unknown".
+
+    Each window is a model of its own, no longer than a year plus the
+    window. That is for programs too big to solve whole, and it doesn't
+    make the time scale with the horizon: windows often dead-end and
+    widen (on the example program with window 24, to the whole year at
+    52 weeks, and to weeks 0-64 or 0-84 at 104). There the whole horizon at once is faster at every
+    horizon up to 3 years (1.1s against 13s for a year), so
+    optimize_schedule only solves by windows when asked to.
+
+    polish=True then re-solves the whole horizon at once in "optimize"
+    mode, starting from the stitched schedule (as a solution hint, where
+    the backend takes one), and keeps that if it finishes within the
+    budget; the stitched schedule otherwise.
+
+    Returns what optimize_schedule does; report["windows"] lists each
+    window solved as (start, stop, status). The rest of the report is the
+    last solve's, so report["optimal"] is False unless that solve covered
+    the whole horizon: the windows before it were optimal only each on
+    its own.
+    """
+    step = window - 4 if step is None else step
+    if window % 4 or step % 4 or not 0 < step <= window:
+        raise ValueError(f"window and step must be multiples of 4 with 0 < step <= window, not {window} and {step}")
+    fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
+    deadline = None if timeout is None else time.monotonic() + timeout
+
+    def remaining():
+        return None if deadline is None else max(0, deadline - time.monotonic())
+
+    rotation = np.full((len(fellows), weeks), -1)
+    windows = []
+    start, stop = 0, min(weeks, window)
+    while True:
+        whole = (start, stop) == (0, weeks)
+        limit = remaining()
+        if not whole and window_timeout is not None:
+            limit = window_timeout if limit is None else min(limit, window_timeout)
+        model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, mode, tactic, soft_rules,
+                              encoding, backend, weeks, window=(start, stop), history=rotation,
+                              restricted=restricted_cohorts(rules, soft_rules))
+        result, report = model.solve_rotation(fellow_week_pairs, rules, timeout=limit,
+                                              max_conflicts=max_conflicts, progress=progress, diagnose=whole)
+        windows.append((start, stop, report["status"]))
+        if result is None:
+            if whole:
+                report["windows"] = windows
+                return None, None, report
+            if remaining() == 0:
+                # stuck on a window: no answer for the request as a whole
+                report["status"] = "unknown"
+                report["windows"] = windows
+                return None, None, report
+            # a dead end: the fixed weeks (or what the window can't see) rule it out
+            start, stop = max(0, start - step), min(weeks, stop + step)
+            continue
+        if stop == weeks:
+            rotation[:, start:] = result[:, start:]
+            break
+        # keep all but the lookahead
+        kept = max(start + step, stop - (window - step))
+        rotation[:, start:kept] = result[:, start:kept]
+        start, stop = kept, min(weeks, kept + window)
+
+    if polish:
+        model = ScheduleModel(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, "optimize", tactic, soft_rules,
+                              encoding, backend, weeks, restricted=restricted_cohorts(rules, soft_rules))
+        polished, polish_report = model.solve_rotation(fellow_week_pairs, rules, timeout=remaining(),
+                                                       max_conflicts=max_conflicts, progress=progress,
+                                                       hint={f: list(row) for f, row in enumerate(rotation)})
+        if polished is not None:
+            rotation, report = polished, polish_report
+            start, stop = 0, weeks
+        report["polish"] = polish_report["status"]
+
+    if (start, stop) != (0, weeks) and "optimal" in report:
+        report["optimal"] = False
+    report["windows"] = windows
+    shifts_for_fellows, fellows_for_shifts = extract_schedule(rotation, fellows, R)
+    return shifts_for_fellows, fellows_for_shifts, report
+
 if __name__ == "__main__":
 
     jr_fellows = ["NCC Raya", "NCC Joseph"]
@@ -469,9 +1330,12 @@ if __name__ == "__main__":
         ],
     }
 
-    shifts_for_fellows, fellows_for_shifts = optimize_schedule(
-        jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+    shifts_for_fellows, fellows_for_shifts, report = optimize_schedule(
+        jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs, cache=ScheduleCache(),
     )
+    if shifts_for_fellows is None:
+        raise SystemExit(f"No schedule ({report['status']}): " + " vs ".join(report.get("conflicts", [])))
+    print(report["status"])
 
     std_output = False
 
@@ -492,131 +1356,8 @@ if __name__ == "__main__":
                 print('+'.join(fellows_for_shifts[s][w]), end=",")
             print('\n')
     else:
-
-        nsYYMMDD = openpyxl.styles.NamedStyle(name="cd1", number_format="YYYY-MM-DD")
-
-        # thick_border = openpyxl.styles.borders.Border(left=openpyxl.styles.borders.Side(style='thick'),
-        #                      right=openpyxl.styles.borders.Side(style='thick'),
-        #                      top=openpyxl.styles.borders.Side(style='thick'),
-        #                      bottom=openpyxl.styles.borders.Side(style='thick'))
-        thick_side = openpyxl.styles.borders.Side(style='thick')
-        def compose_borders(cell, top=None, bottom=None, left=None, right=None):
-            # print(top, bottom, left, right)
-            cell.border = openpyxl.styles.borders.Border(top=top, bottom=bottom, left=left, right=right)
-
-        fellow_fill_dict = {}
-        shift_fill_dict = {}
-        micu_color = "B4C6E7"
-        ncc_color = "C6E0B4"
-        stroke_color = "F8CBAD"
-        swing_color = "A9D08E"
-        vasc_color = "FCE4D6"
-        sicu_color = "FFE699"
-        ns_color = "FFF3CC"
-        anaesthesia_color = "F8CBAD"
-        for f in jr_fellows:
-            fellow_fill_dict[f] = openpyxl.styles.PatternFill(
-                start_color=ncc_color, end_color=ncc_color, fill_type='solid')
-        for f in sr_fellows: fellow_fill_dict[f] = openpyxl.styles.PatternFill(
-                start_color=ncc_color, end_color=ncc_color, fill_type='solid')
-        for f in stroke_fellows: fellow_fill_dict[f] = openpyxl.styles.PatternFill(
-                start_color=stroke_color, end_color=stroke_color, fill_type='solid')
-        for f in CCM_fellows: fellow_fill_dict[f] = openpyxl.styles.PatternFill(
-                start_color=micu_color, end_color=micu_color, fill_type='solid')
-
-        shift_fill_dict['MICU'] = openpyxl.styles.PatternFill(
-            start_color=micu_color, end_color=micu_color, fill_type='solid')
-        shift_fill_dict['SICU'] = openpyxl.styles.PatternFill(
-            start_color=sicu_color, end_color=sicu_color, fill_type='solid')
-        shift_fill_dict['NCC1'] = openpyxl.styles.PatternFill(
-            start_color=ncc_color, end_color=ncc_color, fill_type='solid')
-        shift_fill_dict['NCC2'] = openpyxl.styles.PatternFill(
-            start_color=ncc_color, end_color=ncc_color, fill_type='solid')
-        shift_fill_dict['Swing'] = openpyxl.styles.PatternFill(
-            start_color=swing_color, end_color=swing_color, fill_type='solid')
-        shift_fill_dict['Vasc/Clin'] = openpyxl.styles.PatternFill(
-            start_color=vasc_color, end_color=vasc_color, fill_type='solid')
-        shift_fill_dict['NS'] = openpyxl.styles.PatternFill(
-            start_color=ns_color, end_color=ns_color, fill_type='solid')
-        shift_fill_dict['Anaesthesia'] = openpyxl.styles.PatternFill(
-            start_color=anaesthesia_color, end_color=anaesthesia_color, fill_type='solid')
-
-        wb = openpyxl.Workbook()
-        ws = wb.active
-        ws.title = "Per-Fellow Schedule"
-
-        n_fellows_to_output = len(jr_fellows) + len(sr_fellows)
-        column_letters = "BCDEFGHIJKLMNOPQRSTUVWXYZ"[:n_fellows_to_output]
-        for cl, fellow in zip(column_letters, fellows[:n_fellows_to_output]):
-            ws[f'{cl}1'] = fellow
-
-        ws[f'A1'] = 'Week'
-        ws[f'A2'] = '2025-06-30' # TODO: coordinate with vacation date file constant
-        ws[f'A2'].style = nsYYMMDD
-        for windex in range(3, W+2):
-            ws[f'A{windex}'] = f'=A{windex-1}+7'
-            ws[f'A{windex}'].style = nsYYMMDD
-        for windex in range(2, W + 2):
-            w = windex - 2
-            for cl, fellow in zip(column_letters, fellows[:n_fellows_to_output]):
-                # print(f'formatting {cl}{windex}')
-
-                if (windex-2)%4 == 0:
-                    if cl == 'B': compose_borders(ws[f'{cl}{windex}'], top=thick_side, left=thick_side)
-                    elif cl == column_letters[n_fellows_to_output-1]: compose_borders(ws[f'{cl}{windex}'], top=thick_side, right=thick_side)
-                    else: compose_borders(ws[f'{cl}{windex}'], top=thick_side)
-                elif (windex-1)%4 == 0:
-                    if cl == 'B': compose_borders(ws[f'{cl}{windex}'], bottom=thick_side, left=thick_side)
-                    elif cl == column_letters[n_fellows_to_output-1]: compose_borders(ws[f'{cl}{windex}'], bottom=thick_side, right=thick_side)
-                    else:
-                        compose_borders(ws[f'{cl}{windex}'], bottom=thick_side)
-                else:
-                    if cl == 'B':
-                        compose_borders(ws[f'{cl}{windex}'], left=thick_side)
-                    elif cl == column_letters[n_fellows_to_output - 1]:
-                        compose_borders(ws[f'{cl}{windex}'], right=thick_side)
-
-                ws[f'{cl}{windex}'] = shifts_for_fellows[fellow][w]
-                if shifts_for_fellows[fellow][w] in shift_fill_dict:
-                    ws[f'{cl}{windex}'].fill = shift_fill_dict[shifts_for_fellows[fellow][w]]
-
-        wb.create_sheet("NCC Shift Schedule")
-        ws = wb["NCC Shift Schedule"]
-
-        shifts = ["NCC1", "NCC2", "Extra", "Swing"]
-        column_letters = "BCDEFGHIJKLMNOPQRSTUVWXYZ"[:len(shifts)]
-        for cl, shift in zip(column_letters, shifts):
-            ws[f'{cl}1'] = shift
-
-        ws[f'A1'] = 'Week'
-        ws[f'A2'] = '2025-06-30' # TODO: coordinate with vacation date file constant
-        ws[f'A2'].style = nsYYMMDD
-        for windex in range(3, W+2):
-            ws[f'A{windex}'] = f'=A{windex-1}+7'
-            ws[f'A{windex}'].style = nsYYMMDD
-
-        for windex in range(2, W + 2):
-            w = windex - 2
-            for cl, s in zip(column_letters, shifts):
-
-
-                if (windex-2)%4 == 0:
-                    if cl == 'B': compose_borders(ws[f'{cl}{windex}'], top=thick_side, left=thick_side)
-                    elif cl == column_letters[len(shifts)-1]: compose_borders(ws[f'{cl}{windex}'], top=thick_side, right=thick_side)
-                    else: compose_borders(ws[f'{cl}{windex}'], top=thick_side)
-                elif (windex-1)%4 == 0:
-                    if cl == 'B': compose_borders(ws[f'{cl}{windex}'], bottom=thick_side, left=thick_side)
-                    elif cl == column_letters[len(shifts)-1]: compose_borders(ws[f'{cl}{windex}'], bottom=thick_side, right=thick_side)
-                    else:
-                        compose_borders(ws[f'{cl}{windex}'], bottom=thick_side)
-                else:
-                    if cl == 'B':
-                        compose_borders(ws[f'{cl}{windex}'], left=thick_side)
-                    elif cl == column_letters[n_fellows_to_output - 1]:
-                        compose_borders(ws[f'{cl}{windex}'], right=thick_side)
-
-                ws[f'{cl}{windex}'] = fellows_for_shifts[s][w]
-                if fellows_for_shifts[s][w] in fellow_fill_dict:
-                    ws[f'{cl}{windex}'].fill = fellow_fill_dict[fellows_for_shifts[s][w]]
-
-        wb.save(filename="optimized_schedule.xlsx")
\ No newline at end of file
+        write_workbook(
+            "optimized_schedule.xlsx", shifts_for_fellows, fellows_for_shifts,
+            fellows=jr_fellows + sr_fellows,
+            colors=fellow_colors(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows),
+        )
\ No newline at end of file
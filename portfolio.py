@@ -0,0 +1,124 @@
+import multiprocessing
+import os
+import queue
+import time
+
+import z3
+
+import main
+from backends import cp_model
+
+# Portfolio solving: run the same schedule request under several solver
+# configurations at once, one process each, and take whichever finds a schedule
+# first. Solve times on this model vary wildly between random seeds, so racing a
+# few of them cuts the slow tail.
+
+# Configurations to race, in order of preference; each is a random seed (for z3)
+# plus optimize_schedule settings. Cycled through with fresh seeds when asked for
+# more.
+VARIANTS = [
+    {},
+    {"encoding": "block"},
+    {"symmetry_breaking": True},
+    {"encoding": "block", "symmetry_breaking": True},
+    {"tactic": "qffd"},
+]
+if cp_model is not None:
+    VARIANTS.insert(1, {"backend": "cp-sat"})
+
+def default_configs(n):
+    return [{"seed": i, **VARIANTS[i % len(VARIANTS)]} for i in range(n)]
+
+def _exact(config, rules, soft_rules=None):
+    # Whether config answers the request exactly: the block encoding always
+    # blocks the rotations, so it only does with every *_blocked rule on and hard
+    # (and optimize_schedule refuses it otherwise).
+    if config.get("encoding", "weekly") != "block":
+        return True
+    hard = main.hard_rules(config.get("rules", rules), config.get("soft_rules", soft_rules))
+    return all(name in hard for name in main.BLOCKED_RULES)
+
+def _solve(index, config, args, kwargs, results, forward):
+    # Puts (index, None, progress info) on results as the solver reports progress
+    # (if forward), and then (index, result, None).
+    config = dict(config)
+    seed = config.pop("seed", 0)
+    z3.set_param("smt.random_seed", seed)
+    z3.set_param("sat.random_seed", seed)
+    if forward:
+        kwargs = {**kwargs, "progress": lambda info: results.put((index, None, info))}
+    try:
+        results.put((index, main.optimize_schedule(*args, **{**kwargs, **config}), None))
+    except Exception as e:
+        results.put((index, (None, None, {"status": "error", "error": repr(e)}), None))
+
+def solve_portfolio(jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs,
+                    configs=None, processes=None, timeout=None, progress=None, **kwargs):
+    """
+    Race configs (default: one per core, see default_configs) for this request;
+    kwargs go to optimize_schedule, and each config's settings override them.
+    Returns what optimize_schedule does for the first config to find a
+    schedule, with report["config"] naming it; the other processes are
+    terminated. If none does, the first exact unsat answer (with its
+    conflicts), or else an unknown report once every config has finished or
+    timeout (seconds) has passed.
+
+    progress(info) hears every config's progress reports (see
+    optimize_schedule), in this process, with info["config"] naming the
+    config each comes from.
+    """
+    configs = configs or default_configs(processes or os.cpu_count() or 1)
+    rules = kwargs.get("rules")
+    configs = [c for c in configs if _exact(c, rules, kwargs.get("soft_rules"))] or [{"seed": 0}]
+    args = (jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs)
+
+    # spawn rather than fork: the Streamlit server is multithreaded
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    workers = [
+        context.Process(target=_solve, args=(i, config, args, kwargs, results, progress is not None), daemon=True)
+        for i, config in enumerate(configs)
+    ]
+    for p in workers:
+        p.start()
+
+    deadline = None if timeout is None else time.monotonic() + timeout
+    answer = None
+    try:
+        pending = len(workers)
+        while pending:
+            # poll, so that workers dying without an answer (spawn failure, out of
+            # memory, ...) don't leave us waiting for the whole timeout, or forever
+            remaining = 1 if deadline is None else min(1, max(0, deadline - time.monotonic()))
+            try:
+                index, result, info = results.get(timeout=remaining)
+            except queue.Empty:
+                if deadline is not None and time.monotonic() >= deadline:
+                    break
+                if not any(p.is_alive() for p in workers):
+                    # they may have put their results on the way out
+                    try:
+                        index, result, info = results.get(timeout=1)
+                    except queue.Empty:
+                        break
+                else:
+                    continue
+            if result is None:
+                progress({**info, "config": configs[index]})
+                continue
+            pending -= 1
+            result[2]["config"] = configs[index]
+            if result[2]["status"] in ("sat", "unsat"):
+                # the first sat or unsat answer settles it; every config is exact
+                answer = result
+                break
+            answer = answer or result
+    finally:
+        for p in workers:
+            if p.is_alive():
+                p.terminate()
+        for p in workers:
+            p.join()
+        results.close()
+
+    return answer or (None, None, {"status": "unknown"})
@@ -0,0 +1,41 @@
+# Presolve: work out before a model is built which cells x[f, w, r] are decided
+# already, so that VariableStore makes them constants (see cardinality.py) and the
+# rules fold them away, instead of the solver getting a variable, and the
+# constraints over it, only to propagate its value. Two kinds of cells are
+# decided:
+#
+# - rotations a fellow is never on (see main.fellow_rotations): False in every
+#   week, whatever the request;
+# - cells that a request's hard rules force on their own (first-month MICU,
+#   vacation requests), and what one rotation per week, if hard too, implies for
+#   the rest of each of those fellow-weeks; a soft rule decides nothing, since
+#   the optimum may break it. These only hold for that request: a model presolved with
+#   them can't be asked about others (see ScheduleModel).
+#
+# Nothing is decided against the rules: a fellow-week whose forced cells conflict
+# is left as it is, for the solver to find unsat (and the diagnosis to explain).
+
+
+def presolve(R, weeks, rotations, forced=(), one_per_week=()):
+    # The decided cells, as {(f, w, r): value}. rotations[f] lists the rotations of
+    # R that fellow f can be on at all; forced lists cells (f, w, r) that hold; the
+    # fellows in one_per_week are on at most one rotation a week.
+    fixed = {}
+    for f, allowed in enumerate(rotations):
+        for r in R:
+            if r not in allowed:
+                for w in range(weeks):
+                    fixed[f, w, r] = False
+
+    held = {}
+    for f, w, r in forced:
+        held.setdefault((f, w), set()).add(r)
+    for (f, w), rs in held.items():
+        if any(fixed.get((f, w, r)) is False for r in rs) or (len(rs) > 1 and f in one_per_week):
+            continue
+        for r in R:
+            if r in rs:
+                fixed[f, w, r] = True
+            elif f in one_per_week:
+                fixed[f, w, r] = False
+    return fixed
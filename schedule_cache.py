@@ -0,0 +1,101 @@
+import hashlib
+import json
+import os
+import tempfile
+
+# A cache of solved schedules on local disk, shared by every process that uses
+# the same directory (Streamlit sessions, the CLI). Each entry is one JSON file
+# named by a fingerprint of the request: a hash of its canonical JSON form, so
+# the same fellows, rules and vacations give the same key however the dicts
+# were built. Entries are written atomically (to a temporary file, then
+# renamed), so concurrent readers never see half of one.
+#
+# Least recently used entries are evicted beyond max_entries files or
+# max_bytes in all; a hit touches its file, so the modification times give
+# the order of use.
+
+
+def fingerprint(*parts):
+    # The hash of parts (anything JSON can encode; dict keys sorted).
+    canonical = json.dumps(parts, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode()).hexdigest()
+
+
+def default_directory():
+    return os.environ.get("SCHEDULER_CACHE") or os.path.join(os.path.expanduser("~"), ".cache", "scheduler")
+
+
+class ScheduleCache:
+    def __init__(self, directory=None, max_entries=1000, max_bytes=64 * 2 ** 20):
+        self.directory = directory or default_directory()
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        return fingerprint(*parts)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ".json")
+
+    def get(self, key):
+        # The value stored under key, or None.
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                value = json.load(f)
+            os.utime(path)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError):
+            # unreadable (say, from an older version): drop it
+            self._remove(path)
+            return None
+        return value
+
+    def put(self, key, value):
+        os.makedirs(self.directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(value, f)
+            os.replace(tmp, self._path(key))
+        except BaseException:
+            self._remove(tmp)
+            raise
+        self._evict()
+
+    def clear(self):
+        for path, _, _ in self._entries():
+            self._remove(path)
+
+    def _entries(self):
+        # (path, size, last used) of every entry
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return entries
+        for name in names:
+            if name.endswith(".json"):
+                path = os.path.join(self.directory, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((path, stat.st_size, stat.st_mtime))
+        return entries
+
+    def _evict(self):
+        entries = sorted(self._entries(), key=lambda e: e[2])
+        size = sum(s for _, s, _ in entries)
+        while entries and (len(entries) > self.max_entries or size > self.max_bytes):
+            path, s, _ = entries.pop(0)
+            self._remove(path)
+            size -= s
+
+    def _remove(self, path):
+        # another process may have got there first
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
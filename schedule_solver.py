@@ -0,0 +1,309 @@
+import functools
+import time
+from contextlib import contextmanager
+
+from cardinality import UNKNOWN
+from symmetry import rule_fellows
+
+# the profile entry for constraints and variables added outside any rule (the
+# schedule's cells, derived rotations, rule guards, ...)
+MODEL = "(model)"
+
+
+def rule(fn):
+    # Every rule takes soft= and weight=. A soft rule's constraints may be violated,
+    # each at a cost of `weight` (see ScheduleSolver.add). By default a rule is soft
+    # iff it is listed in the solver's soft_rules, with the weight given there.
+    @functools.wraps(fn)
+    def wrapped(o, *args, soft=None, weight=None, **kwargs):
+        if soft is None:
+            soft = fn.__name__ in o.soft_rules
+        if weight is None:
+            weight = o.soft_rules.get(fn.__name__, 1)
+        # remember which fellows the rule applies to, for symmetry detection
+        applied = rule_fellows(fn, (o,) + args, kwargs)
+        if applied is not None:
+            fellows, arguments = applied
+            o.applications[fn.__name__, arguments] = fellows
+        with o.rule(fn.__name__, soft=soft, weight=weight):
+            return fn(o, *args, **kwargs)
+    return wrapped
+
+
+class ScheduleSolver:
+    # The `o` handed to every rule: wraps a solver backend (backends.py). Rules add
+    # constraints through cardinality.py; inside a soft rule each added constraint
+    # gets its own violation literal instead, and violating it is charged to the
+    # rule. Inside guarded(g) everything added only applies when g holds, so a rule
+    # can be switched on and off by passing g (or neg(g)) to check() as an
+    # assumption.
+
+    def __init__(self, backend, soft_rules=None, optimize=False):
+        self.backend = backend
+        self.soft_rules = soft_rules or {}
+        # minimize the violated soft constraints' weight (else just try to keep them)
+        self.optimize = optimize
+        # rule name -> [(constraint, violation literal, weight, guard)]
+        self.soft = {}
+        # (name, soft, weight) of the rule currently adding constraints
+        self._rule = None
+        # guard literal of the rule currently adding constraints, if any
+        self._guard = None
+        # while diagnosing: labeler(rule name, literals) -> label, and the
+        # tracking literal per label
+        self._labeler = None
+        self.tracking = {}
+        # number of soft constraints per rule at each push(), and the profile then
+        self._scopes = []
+        # What each rule costs to build: rule name (MODEL for whatever is added
+        # outside the rules) -> {"time": seconds spent in the rule, "constraints"
+        # posted, "literals" in them, "variables": fresh literals}, for everything
+        # now in the solver (what a scope added is forgotten when it is popped).
+        # Time is the rule's own, not counting rules it calls.
+        self.profile = {}
+        self._since = None
+        # (rule name, other arguments) -> fellows, for every rule applied so far
+        self.applications = {}
+        # budget of the current solve (see budget()): wall-clock deadline and
+        # conflicts per check, and the progress(info) callback
+        self._started = None
+        self._deadline = None
+        self._conflicts = None
+        self.progress = None
+        backend.on_model = self._improved
+
+    def __getattr__(self, name):
+        # key(), values(), statistics(), ... go straight to the backend
+        return getattr(self.backend, name)
+
+    def new_bool(self, name):
+        self._profiled()["variables"] += 1
+        return self.backend.new_bool(name)
+
+    def _post(self, kind, lits, params, conditions):
+        entry = self._profiled()
+        entry["constraints"] += 1
+        entry["literals"] += len(lits) + len(conditions)
+        self.backend.post(kind, lits, params, conditions)
+
+    def _profiled(self):
+        # the profile entry of the rule currently adding constraints
+        name = self._rule[0] if self._rule is not None else MODEL
+        if name not in self.profile:
+            self.profile[name] = {"time": 0.0, "constraints": 0, "literals": 0, "variables": 0}
+        return self.profile[name]
+
+    def _clock(self):
+        # charge the time since the last call to the rule currently running
+        now = time.perf_counter()
+        if self._rule is not None:
+            self._profiled()["time"] += now - self._since
+        self._since = now
+
+    def neg(self, l):
+        # Constants (see cardinality.py) stay constants: True, False or UNKNOWN.
+        if l is UNKNOWN:
+            return UNKNOWN
+        if isinstance(l, bool):
+            return not l
+        return self.backend.neg(l)
+
+    @contextmanager
+    def rule(self, name, soft=False, weight=1):
+        outer = self._rule
+        self._clock()
+        self._rule = (name, soft, weight)
+        try:
+            yield
+        finally:
+            self._clock()
+            self._rule = outer
+
+    @contextmanager
+    def guarded(self, guard):
+        outer = self._guard
+        self._guard = guard
+        try:
+            yield
+        finally:
+            self._guard = outer
+
+    @contextmanager
+    def tracked(self, labeler):
+        # Track everything added in here for unsat cores: each constraint is guarded
+        # by a literal named after labeler(rule name, its literals), so constraints
+        # with the same label (e.g. the same rule and fellow) share one literal.
+        outer = self._labeler
+        self._labeler = labeler
+        try:
+            yield
+        finally:
+            self._labeler = outer
+
+    @contextmanager
+    def budget(self, timeout=None, conflicts=None, progress=None):
+        # Everything checked in here shares timeout seconds of wall-clock time, and
+        # each check stops after conflicts conflicts; a check out of budget is
+        # "unknown". progress(info) hears of each improving solution found while
+        # optimizing, and anything passed to report().
+        self._started = time.monotonic()
+        self._deadline = None if timeout is None else self._started + timeout
+        self._conflicts = conflicts
+        self.progress = progress
+        try:
+            yield
+        finally:
+            self._deadline = self._conflicts = self.progress = None
+            self.backend.set_budget()
+
+    def remaining(self):
+        # milliseconds left in the budget, or None if unbounded
+        if self._deadline is None:
+            return None
+        return max(0, (self._deadline - time.monotonic()) * 1000)
+
+    def elapsed(self):
+        # seconds since the budget started
+        return time.monotonic() - self._started
+
+    def report(self, **info):
+        if self.progress is not None:
+            self.progress({"elapsed": self.elapsed(), **info})
+
+    def _improved(self):
+        if self.progress is not None:
+            self.report(objective=sum(self.violation_costs().values()))
+
+    def _check(self, assumptions, timeout=None):
+        # One backend check within the budget, and within timeout ms if given.
+        left = self.remaining()
+        if left == 0:
+            return "unknown"
+        if timeout is not None:
+            left = timeout if left is None else min(left, timeout)
+        self.backend.set_budget(left, self._conflicts)
+        return self.backend.check(assumptions)
+
+    def push(self):
+        self.backend.push()
+        self._scopes.append((
+            {name: len(soft) for name, soft in self.soft.items()},
+            {name: dict(entry) for name, entry in self.profile.items()},
+        ))
+
+    def pop(self):
+        self.backend.pop()
+        sizes, self.profile = self._scopes.pop()
+        self.soft = {name: soft[:sizes[name]] for name, soft in self.soft.items() if name in sizes}
+
+    def add(self, kind, lits, *params, enforce=None):
+        # One constraint (see backends.py for the kinds), applying only if enforce
+        # holds when given. enforce may be a constant (see cardinality.py); one that
+        # is False, or unknown, drops the constraint.
+        if enforce is False or enforce is UNKNOWN:
+            return
+        if enforce is True:
+            enforce = None
+        conditions = [enforce] if enforce is not None else []
+        if self._labeler is not None:
+            rule_name = self._rule[0] if self._rule is not None else ""
+            label = self._labeler(rule_name, lits)
+            if label not in self.tracking:
+                self.tracking[label] = self.new_bool(f"track_{label}")
+            self._post(kind, lits, params, [self.tracking[label]] + conditions)
+        elif self._rule is not None and self._rule[1]:
+            name, _, weight = self._rule
+            self.add_soft((kind, lits, params, enforce), weight, id=name)
+        elif self._guard is not None:
+            self._post(kind, lits, params, [self._guard] + conditions)
+        else:
+            self._post(kind, lits, params, conditions)
+
+    def define(self, kind, lits, *params):
+        # Definitions of auxiliary variables are never soft, whichever rule needs them.
+        self._post(kind, lits, params, [])
+
+    def add_soft(self, constraint, weight=1, id="soft"):
+        # constraint is (kind, literals, parameters, enforce literal or None)
+        kind, lits, params, enforce = constraint
+        soft = self.soft.setdefault(id, [])
+        violated = self.new_bool(f"violated_{id}_{len(soft)}")
+        conditions = [c for c in [self._guard, enforce] if c is not None]
+        self._post(kind, lits, params, conditions + [self.backend.neg(violated)])
+        soft.append((constraint, violated, weight, self._guard))
+        if self.optimize:
+            self.backend.minimize(violated, weight, id)
+
+    def check(self, *assumptions):
+        if self.optimize or not self.soft:
+            return self._check(list(assumptions))
+
+        # Feasibility: ask for every soft constraint to hold, and only give up on
+        # the ones the solver reports as conflicting, until the rest is sat.
+        kept = [self.backend.neg(v) for soft in self.soft.values() for _, v, _, _ in soft]
+        while True:
+            result = self._check(list(assumptions) + kept)
+            if result != "unsat":
+                return result
+            core = {id(c) for c in self.backend.core(kept)}
+            relaxed = [a for a in kept if id(a) not in core]
+            if len(relaxed) == len(kept):
+                # the hard constraints conflict on their own
+                return result
+            kept = relaxed
+
+    def minimal_core(self, assumptions, timeout=None):
+        # A minimal subset of assumptions that is unsat with the asserted constraints,
+        # or None if they aren't unsat. Deletion-based: starting from the solver's
+        # core, drop each assumption in turn and keep it out if the rest is still
+        # unsat. timeout (ms) bounds each check, as does the budget; a check that
+        # times out keeps its assumption, so the result may then be a core that is
+        # not quite minimal.
+        if self._check(assumptions, timeout) != "unsat":
+            return None
+        core = self.backend.core(assumptions)
+        i = 0
+        while i < len(core):
+            trial = core[:i] + core[i + 1:]
+            if self._check(trial, timeout) == "unsat":
+                core = self.backend.core(trial)
+            else:
+                i += 1
+        return core
+
+    def violation_costs(self):
+        # Cost per soft rule of the last solution: the summed weight of its
+        # constraints that do not hold (and are switched on).
+        return {
+            name: sum(
+                weight for constraint, _, weight, guard in soft
+                if (guard is None or self.backend.values([guard])[0]) and not self.holds(*constraint)
+            )
+            for name, soft in self.soft.items()
+        }
+
+    def holds(self, kind, lits, params, enforce=None):
+        # Whether a constraint holds in the last solution.
+        if enforce is not None and not self.backend.values([enforce])[0]:
+            return True
+        values = self.backend.values(lits)
+        n = sum(values)
+        if kind == "all":
+            return n == len(lits)
+        if kind == "clause":
+            return n > 0
+        if kind == "at_least":
+            return n >= params[0]
+        if kind == "at_most":
+            return n <= params[0]
+        if kind == "exactly":
+            return n == params[0]
+        if kind == "linear":
+            coeffs, lo, hi = params
+            total = sum(c for c, v in zip(coeffs, values) if v)
+            return (lo is None or total >= lo) and (hi is None or total <= hi)
+        if kind == "equal":
+            return n in (0, len(lits))
+        if kind == "is_or":
+            return values[0] == any(values[1:])
+        raise ValueError(f"Unknown constraint kind {kind!r}")
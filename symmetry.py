@@ -0,0 +1,94 @@
+import inspect
+
+from cardinality import clause, weighted_between
+
+# Symmetry breaking. Rules are applied to ranges of fellows and treat every fellow
+# in a range alike, so two fellows that are in exactly the same rule applications
+# and have the same requests can swap schedules. We order such fellows'
+# schedules lexicographically, which keeps one schedule out of each set of swaps.
+
+# Pairs of rotations that every rule treats alike (rules only count them
+# together, or each the same way), so they can be swapped in any week.
+SYMMETRIC_ROTATIONS = [("NCC1", "NCC2")]
+
+
+def rule_fellows(fn, args, kwargs):
+    # The fellows a rule call applies to, and the rest of its arguments, from the
+    # fellow range arguments the rules take. None if the call has per-fellow data
+    # (vacation_requests) or no fellow range we know of.
+    bound = inspect.signature(fn).bind(*args, **kwargs)
+    bound.apply_defaults()
+    arguments = dict(bound.arguments)
+    for name in ["o", "x", "R"]:
+        arguments.pop(name, None)
+    if "fellow_start" in arguments:
+        fellows = range(arguments.pop("fellow_start"), arguments.pop("fellow_end"))
+    elif "fellow_min" in arguments:
+        fellows = range(arguments.pop("fellow_min"), arguments.pop("fellow_max"))
+    elif "N" in arguments:
+        fellows = range(arguments.pop("N"))
+    elif "f" in arguments:
+        fellows = [arguments.pop("f")]
+    else:
+        return None
+    return frozenset(fellows), tuple(sorted((k, repr(v)) for k, v in arguments.items()))
+
+
+def fellow_classes(applications, N, fellow_week_pairs, fellows):
+    # Groups of interchangeable fellows, in order of their first member.
+    # applications maps (rule name, other arguments) -> the fellows it applies to.
+    requests = {fellows.index(f_): tuple(w_) for f_, w_ in fellow_week_pairs.items()}
+    classes = {}
+    for f in range(N):
+        signature = (
+            frozenset(key for key, members in applications.items() if f in members),
+            requests.get(f, ()),
+        )
+        classes.setdefault(signature, []).append(f)
+    return sorted(classes.values())
+
+
+def lex_greater_equal(o, name, a, b):
+    # a >= b lexicographically, for equal-length lists of literals (True > False).
+    # e[i] means a[:i] == b[:i]; while that holds, a[i] >= b[i], and equality at i
+    # carries on to i + 1.
+    e = True
+    for i, (a_i, b_i) in enumerate(zip(a, b)):
+        not_e = False if e is True else o.neg(e)
+        clause(o, [not_e, a_i, o.neg(b_i)])
+        if i + 1 < len(a):
+            e_next = o.new_bool(f"{name}_{i}")
+            # e and a[i] == b[i] -> e_next, as clauses for both values of a[i]
+            clause(o, [not_e, o.neg(a_i), o.neg(b_i), e_next])
+            clause(o, [not_e, a_i, b_i, e_next])
+            e = e_next
+
+
+def break_symmetries(o, x, R, classes, W, order_by=None):
+    # Interchangeable fellows: each one's schedule is lexicographically >= the
+    # next one's, comparing week by week the rotations in order_by (default: all
+    # of R). Comparing only part of the schedule is still sound, it just leaves
+    # some symmetry in; the lex chains over all of R cost more than they saved.
+    order_by = order_by or R
+    for members in classes:
+        for f1, f2 in zip(members, members[1:]):
+            lex_greater_equal(o, f"lex_{f1}_{f2}",
+                              [x[f1, w, r] for w in range(W) for r in order_by],
+                              [x[f2, w, r] for w in range(W) for r in order_by])
+
+    # Symmetric rotations: within each week, swapping them for everyone is a
+    # symmetry, so require the first to be "ahead" of the second. This compares
+    # how many of each class of fellows are on them (weighted so that the first
+    # classes dominate), which doesn't change when fellows within a class are
+    # reordered above, nor NCC-ish; the two orderings are therefore compatible.
+    weighted = classes[:8]
+    for r1, r2 in SYMMETRIC_ROTATIONS:
+        if r1 not in R or r2 not in R:
+            continue
+        for w in range(W):
+            terms = []
+            for i, members in enumerate(weighted):
+                c = 5 ** (len(weighted) - i - 1)
+                terms += [(x[f, w, r1], c) for f in members] + [(x[f, w, r2], -c) for f in members]
+            if terms:
+                weighted_between(o, terms, 0, None)
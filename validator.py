@@ -0,0 +1,274 @@
+import numpy as np
+
+from main import (
+    W, N_VAC, JR_QUOTAS, SR_QUOTAS, NICU, NCC_ISH, CORE_ICU,
+    resolve_rules, fellow_rotations, restricted_cohorts,
+)
+
+# Checking a finished schedule against the rules without a solver, e.g. one
+# edited by hand in the workbook: the schedule as a fellow x week matrix of
+# indices into R (-1 for none, as VariableStore.assignment gives it), and every
+# rule evaluated on it with NumPy. A rule's violations are counted the way a soft
+# rule's are (see ScheduleSolver.violation_costs): one per constraint it posts
+# that doesn't hold, so a hand-edited schedule scores as the solver would score
+# it.
+#
+# Matrices may have leading batch dimensions (K x N x weeks, ...): every count
+# then comes back per schedule, so screening many candidates at once (say, as a
+# search's fitness function) costs about as much as checking one.
+#
+# For a workbook (file name), the schedule is
+#
+#     schedule_matrix(read_schedule(filename), fellows, R, read_shift_schedule(filename))
+#
+# Keep the rules here in step with the ones in main.py: the fellows each applies
+# to are those in ScheduleModel.rule_calls.
+
+# the violation cost of a hard rule's constraint in score()
+HARD_WEIGHT = 1000
+
+
+def schedule_matrix(shifts_for_fellows, fellows, R, fellows_for_shifts=None):
+    # The fellow x week matrix of shifts_for_fellows ({fellow: [rotation name or
+    # "" per week]}). Fellows it doesn't have (a workbook only lists the NCC
+    # fellows) get their NCC time from fellows_for_shifts ({"NCC1": [fellow per
+    # week, several joined by ", "], ...}, as extract_schedule gives it) if
+    # given, and nothing otherwise; an "Extra" fellow is counted on NCC1.
+    weeks = len(next(iter(shifts_for_fellows.values()))) if shifts_for_fellows else W
+    rotation = np.full((len(fellows), weeks), -1, dtype=np.int8)
+    for fellow, shifts in shifts_for_fellows.items():
+        if fellow not in fellows:
+            raise ValueError(f"Unknown fellow {fellow!r} in the schedule")
+        unknown = set(shifts) - set(R) - {"", None}
+        if unknown:
+            raise ValueError(f"Unknown rotations {sorted(unknown)} for {fellow!r} in the schedule")
+        rotation[fellows.index(fellow)] = [R.index(s) if s else -1 for s in shifts]
+    for shift, on in (fellows_for_shifts or {}).items():
+        r = R.index("NCC1" if shift == "Extra" else shift)
+        for w, names in enumerate(on):
+            for fellow in (names or "").split(", "):
+                if fellow and fellow not in shifts_for_fellows:
+                    rotation[fellows.index(fellow), w] = r
+    return rotation
+
+
+class Validator:
+    # The rules (enabled and parameterized as for optimize_schedule) and vacation
+    # requests of one program, ready to check any number of its schedules.
+
+    def __init__(self, jr_fellows, sr_fellows, stroke_fellows, CCM_fellows, R, fellow_week_pairs=None, rules=None):
+        self.fellows = jr_fellows + sr_fellows + stroke_fellows + CCM_fellows
+        self.R = list(R)
+        self.rules = resolve_rules(rules)
+        self.fellow_week_pairs = fellow_week_pairs or {}
+        nj, ns, nst = len(jr_fellows), len(sr_fellows), len(stroke_fellows)
+        self.N = N = len(self.fellows)
+        # fellows each group of rules applies to, as in ScheduleModel.rule_calls
+        self.jr = slice(0, nj)
+        self.sr = slice(nj, nj + ns)
+        self.ncc = slice(0, nj + ns)
+        self.stroke = slice(nj + ns, nj + ns + nst)
+        self.ccm = slice(nj + ns + nst, N)
+        self.oversight = slice(0, nj + ns + nst)
+        self.everyone = slice(0, N)
+        # allowed[f, i]: fellow f may be on rotation i of R (under these rules the
+        # model never puts a fellow of a restricted cohort on a rotation outside
+        # their cohort's, see restricted_cohorts); the last column is "none",
+        # always allowed
+        allowed = np.ones((N, len(self.R) + 1), dtype=bool)
+        restricted = restricted_cohorts(rules)
+        for cohort, group, quotas in [("jr", self.jr, JR_QUOTAS), ("sr", self.sr, SR_QUOTAS),
+                                      ("stroke", self.stroke, None), ("CCM", self.ccm, None)]:
+            if cohort in restricted:
+                allowed[group, :-1] = [r in fellow_rotations(self.R, quotas) for r in self.R]
+        self.allowed = allowed
+
+    def violations(self, rotation):
+        # {rule name: number of its constraints that don't hold} for the enabled
+        # rules, "vacation_requests", "fellow_rotations" (fellows on rotations
+        # their cohort is never on) and "swing_coverage" (weeks without swing,
+        # what "optimize" mode minimizes); each count an int, or an array over the
+        # batch dimensions.
+        rotation = np.asarray(rotation)
+        if rotation.shape[-2] != self.N or rotation.shape[-1] % W:
+            raise ValueError(f"Expected {self.N} fellows x a whole number of {W}-week years, not {rotation.shape[-2:]}")
+        s = _Schedules(rotation, self.R)
+        counts = {}
+        for name, params in self.rules.items():
+            counts[name] = getattr(self, name)(s, **params)
+        counts["vacation_requests"] = self.vacation_requests(s)
+        counts["fellow_rotations"] = s.total(~self.allowed[np.arange(self.N)[:, None], rotation])
+        counts["swing_coverage"] = s.total(~s.on["Swing"].any(axis=-2))
+        return counts
+
+    def valid(self, rotation):
+        # whether every rule holds (swing coverage is only an objective)
+        counts = self.violations(rotation)
+        return sum(v for name, v in counts.items() if name != "swing_coverage") == 0
+
+    def score(self, rotation, soft_rules=None, hard_weight=HARD_WEIGHT):
+        # The total violation cost: each violated constraint of a rule in
+        # soft_rules ({rule name: weight}, "swing_coverage" included) costs its
+        # weight, and of any other rule hard_weight. Lower is better; 0 is a
+        # schedule meeting every rule.
+        soft_rules = soft_rules or {}
+        counts = self.violations(rotation)
+        return sum(
+            v * soft_rules[name] if name in soft_rules else v * hard_weight
+            for name, v in counts.items() if name in soft_rules or name != "swing_coverage"
+        )
+
+    # The rules, as in main.py, with the same parameters.
+
+    def range_fellows_assigned_fully(self, s):
+        return s.total(s.rotation[..., self.ncc, :] < 0)
+
+    def everyone_one_rotation_per_week(self, s):
+        # a matrix has one rotation per fellow-week at most
+        return s.nothing()
+
+    def ncc_shifts_covered_swing_deficit(self, s, deficit):
+        ncc1 = s.per_week("NCC1", self.everyone)
+        ncc2 = s.per_week("NCC2", self.everyone)
+        weekly = (
+            s.total(ncc1 < 1) + s.total(ncc2 < 1) + s.total(ncc1 > 2) + s.total(ncc2 > 2)
+            + s.total(ncc1 + ncc2 > 3) + s.total(s.per_week("Swing", self.everyone) > 1)
+        )
+        swing = s.weeks("Swing", self.everyone).sum(axis=(-3, -1))
+        return weekly + s.total(swing < W - deficit)
+
+    def ncc_stroke_oversight(self, s):
+        return s.total(s.per_week(NICU, self.oversight) < 1)
+
+    def maximum_consecutive_icu_shifts(self, s, MAX_CONSEC):
+        if s.n_weeks <= MAX_CONSEC:
+            return s.nothing()
+        icu = s.on[CORE_ICU][..., self.everyone, :]
+        running = np.concatenate([np.zeros(icu.shape[:-1] + (1,), dtype=int), icu.cumsum(axis=-1)], axis=-1)
+        # ICU weeks in each window of MAX_CONSEC + 1, for the windows the rule checks
+        starts = np.arange(s.n_weeks - MAX_CONSEC)
+        return s.total(running[..., starts + MAX_CONSEC + 1] - running[..., starts] > MAX_CONSEC)
+
+    def jr_first_month_micu(self, s):
+        return s.total(~s.weeks("MICU", self.jr)[..., :4].all(axis=-1))
+
+    def jr_ncc_before_19(self, s, last_week=19):
+        return s.total(~s.weeks(NICU, self.jr)[..., 4:last_week].any(axis=-1))
+
+    def ccm_total_service(self, s):
+        per_year = (
+            s.total(s.weeks(NICU, self.ccm).sum(axis=-1) != 3)
+            + s.total(s.weeks("Swing", self.ccm).sum(axis=-1) != 1)
+        )
+        nccish = s.blocks(NCC_ISH, self.ccm, 4)
+        swing = s.blocks("Swing", self.ccm, 4).sum(axis=-1)
+        return per_year + s.total(s.mixed(nccish)) + s.total(nccish[..., 0] & (swing != 1))
+
+    def stroke_total_service(self, s):
+        return (
+            s.total(s.weeks("Swing", self.stroke).sum(axis=-1) < 2)
+            + s.total(s.weeks(NICU, self.stroke).sum(axis=-1) < 6)
+        )
+
+    def _quotas(self, s, fellows, quotas):
+        return sum(
+            s.total(s.weeks(r, fellows).sum(axis=-1) < n) for r, n in quotas.items() if n > 0
+        )
+
+    def ncc_jr_total_service(self, s):
+        return self._quotas(s, self.jr, JR_QUOTAS)
+
+    def ncc_sr_total_service(self, s):
+        return self._quotas(s, self.sr, SR_QUOTAS)
+
+    def jr_fellows_n_ncc_before_swing(self, s, n):
+        if n <= 0:
+            return s.nothing()
+        nicu = s.weeks(NICU, self.jr)
+        swing = s.weeks("Swing", self.jr)
+        # NCC weeks earlier in the year than each week
+        before = nicu.cumsum(axis=-1) - nicu
+        return s.total(swing & (before < n)) + s.total(~swing.any(axis=-1))
+
+    def sicu_blocked(self, s):
+        return s.total(s.mixed(s.blocks("SICU", self.jr, 4)))
+
+    def micu_blocked(self, s):
+        return s.total(s.mixed(s.blocks("MICU", self.ncc, 2)))
+
+    def anaesthesia_blocked(self, s):
+        return s.total(s.mixed(s.blocks("Anaesthesia", self.jr, 4)))
+
+    def vasc_blocked(self, s):
+        return s.total(s.mixed(s.blocks("Vasc/Clin", self.sr, 4)))
+
+    def ns_blocked(self, s):
+        ns = s.blocks("NS", self.sr, 4)
+        return s.total(s.mixed(ns[..., :3])) + s.total(ns[..., 3] & ~ns[..., 0])
+
+    def ncc_blocked(self, s):
+        return s.total(s.mixed(s.blocks(NCC_ISH, self.everyone, 2)))
+
+    def fourth_block_two_micu_fellows(self, s):
+        micu = s.weeks("MICU", self.ncc)[..., 12:16].sum(axis=-3)
+        return s.total(micu != 2)
+
+    def comparable_amounts_each_half_year(self, s):
+        total = 0
+        for r in ["MICU", NCC_ISH]:
+            on = s.weeks(r, self.ncc)
+            difference = on[..., :W // 2].sum(axis=-1) - on[..., W // 2:].sum(axis=-1)
+            total = total + s.total(np.abs(difference) > 4)
+        return total
+
+    def vacation_requests(self, s):
+        total = s.nothing()
+        for fellow, weeks in self.fellow_week_pairs.items():
+            f = self.fellows.index(fellow)
+            for r, requested in [("Vac", weeks[:N_VAC]), ("Elec", weeks[N_VAC:])]:
+                if requested:
+                    total = total + ~s.on[r][..., f, requested].all(axis=-1)
+        return total
+
+
+class _Schedules:
+    # One or more schedules (rotation, batch dimensions first) as boolean arrays
+    # per rotation, derived ones included, and how to count in them: total()
+    # gives the number of True entries per schedule.
+
+    def __init__(self, rotation, R):
+        self.batch = rotation.shape[:-2]
+        self.n_weeks = rotation.shape[-1]
+        self.rotation = rotation
+        self.on = {r: rotation == i for i, r in enumerate(R)}
+        none = np.zeros(rotation.shape, dtype=bool)
+        for r in ["NCC1", "NCC2", "Swing", "SICU", "MICU", "NS", "Vac", "Elec", "Anaesthesia", "Vasc/Clin"]:
+            self.on.setdefault(r, none)
+        self.on[NICU] = self.on["NCC1"] | self.on["NCC2"]
+        self.on[NCC_ISH] = self.on[NICU] | self.on["Swing"]
+        self.on[CORE_ICU] = self.on[NCC_ISH] | self.on["SICU"] | self.on["MICU"]
+
+    def nothing(self):
+        # no violations
+        return np.zeros(self.batch, dtype=int)
+
+    def total(self, violated):
+        return violated.reshape(self.batch + (-1,)).sum(axis=-1)
+
+    def weeks(self, r, fellows):
+        # fellows' weeks on r, split by year: (..., fellows, years, W)
+        on = self.on[r][..., fellows, :]
+        return on.reshape(on.shape[:-1] + (self.n_weeks // W, W))
+
+    def blocks(self, r, fellows, size):
+        # fellows' weeks on r, in blocks of size weeks: (..., fellows, blocks, size)
+        on = self.on[r][..., fellows, :]
+        return on.reshape(on.shape[:-1] + (self.n_weeks // size, size))
+
+    def per_week(self, r, fellows):
+        # how many of fellows are on r each week: (..., weeks)
+        return self.on[r][..., fellows, :].sum(axis=-2)
+
+    def mixed(self, blocks):
+        # blocks neither all on nor all off
+        return blocks.any(axis=-1) & ~blocks.all(axis=-1)
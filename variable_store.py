@@ -0,0 +1,102 @@
+import numpy as np
+
+from cardinality import UNKNOWN, is_literal
+
+
+class VariableStore:
+    # x[f, w, r]: the literal for fellow f in week w on rotation r (by name), kept in
+    # one flat list. The layout is fellow-major, then rotation, then week, so all
+    # weeks of a fellow-rotation are a contiguous slice (weeks) and all fellows of a
+    # week-rotation a strided one (fellows); rules use those directly instead of
+    # hashing an (f, w, r) tuple per variable.
+    #
+    # The real rotations R get a fresh literal each, from new_bool(name) (the
+    # solver's), in the weeks listed in free (default: all), except for the cells
+    # already decided in fixed ({(f, w, r): value}, see presolve.py), which are
+    # those constants. The other weeks start out UNKNOWN, for the caller to leave
+    # so or fix to True/False (see cardinality.py). Derived rotations are listed up
+    # front to reserve their slots, and filled in later (see main.derived_rotations).
+
+    def __init__(self, N, W, R, new_bool, derived=(), free=None, fixed=None):
+        self.N, self.W = N, W
+        self.R = list(R)
+        self.rotations = self.R + list(derived)
+        self.index = {r: i for i, r in enumerate(self.rotations)}
+        self.stride = len(self.rotations) * W
+        self.vars = [None] * (N * self.stride)
+        free = range(W) if free is None else free
+        fixed = fixed or {}
+        for f in range(N):
+            for i, r in enumerate(self.R):
+                base = f * self.stride + i * W
+                self.vars[base:base + W] = [UNKNOWN] * W
+                for w in free:
+                    value = fixed.get((f, w, r))
+                    self.vars[base + w] = new_bool(f"x_{f}_{w}_{r}") if value is None else value
+
+    def without(self, weeks):
+        # A copy with weeks (of every rotation, derived too) made UNKNOWN, for
+        # rules that should not see them.
+        x = object.__new__(VariableStore)
+        x.__dict__.update(self.__dict__)
+        x.vars = list(self.vars)
+        for f in range(self.N):
+            for i in range(len(self.rotations)):
+                base = f * self.stride + i * self.W
+                for w in weeks:
+                    x.vars[base + w] = UNKNOWN
+        return x
+
+    def offset(self, f, w, r):
+        return f * self.stride + self.index[r] * self.W + w
+
+    def __getitem__(self, key):
+        f, w, r = key
+        return self.vars[self.offset(f, w, r)]
+
+    def __setitem__(self, key, value):
+        f, w, r = key
+        self.vars[self.offset(f, w, r)] = value
+
+    def weeks(self, f, r, start=0, stop=None):
+        # fellow f on rotation r, for weeks start..stop-1
+        stop = self.W if stop is None else stop
+        base = f * self.stride + self.index[r] * self.W
+        return self.vars[base + start:base + stop]
+
+    def fellows(self, w, r, start=0, stop=None):
+        # fellows start..stop-1 on rotation r in week w
+        stop = self.N if stop is None else stop
+        first = self.index[r] * self.W + w
+        return self.vars[first + start * self.stride:first + stop * self.stride:self.stride]
+
+    def week(self, f, w, rotations=None):
+        # fellow f in week w, on each of rotations (default: the real rotations R)
+        if rotations is None or list(rotations) == self.R:
+            base = f * self.stride + w
+            return self.vars[base:base + len(self.R) * self.W:self.W]
+        return [self[f, w, r] for r in rotations]
+
+    def items(self):
+        # ((f, w, r), literal) for every solver literal (not the constants)
+        for f in range(self.N):
+            for i, r in enumerate(self.rotations):
+                base = f * self.stride + i * self.W
+                for w in range(self.W):
+                    v = self.vars[base + w]
+                    if v is not None and is_literal(v):
+                        yield (f, w, r), v
+
+    def assignment(self, values):
+        # The schedule as an N x W int matrix: the index in R of each fellow-week's
+        # rotation, or -1 for none (the first in R if several hold; UNKNOWN counts
+        # as not). values(lits) says which literals hold in the solution (the
+        # solver's values()).
+        real = [v for f in range(self.N) for v in self.vars[f * self.stride:f * self.stride + len(self.R) * self.W]]
+        lits = [i for i, v in enumerate(real) if is_literal(v)]
+        held = np.array([v is True for v in real], dtype=bool)
+        held[lits] = values([real[i] for i in lits])
+        held = held.reshape(self.N, len(self.R), self.W)
+        rotation = held.argmax(axis=1)
+        rotation[~held.any(axis=1)] = -1
+        return rotation